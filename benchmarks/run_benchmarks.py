@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import requests
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+fixture_dir = os.path.join(benchmark_dir, "fixtures")
+sys.path.insert(0, os.path.dirname(benchmark_dir))
+
+# The bot reads its settings on import. The URLs only tell the services apart and are never requested.
+os.environ.setdefault("DEV_TELE_ID", "0")
+os.environ.setdefault("COMP_VISION_TOKEN", "benchmark")
+os.environ.setdefault("COMP_VISION_ANALYSIS_URL", "https://vision.invalid/analyze")
+os.environ.setdefault("COMP_VISION_TEXT_URL", "https://vision.invalid/recognizeText")
+os.environ.setdefault("EMOTION_TOKEN", "benchmark")
+os.environ.setdefault("EMOTION_URL", "https://emotion.invalid/recognize")
+
+import cognitive_bot as bot
+import cognitive_lang
+import samples
+
+benchmarks = []
+
+
+# Registers a benchmark. The function sets it up and returns the function to measure, or None to skip it.
+def benchmark(name):
+    def decorator(func):
+        benchmarks.append((name, func))
+
+        return func
+
+    return decorator
+
+
+def load_fixture(name):
+    with open(os.path.join(fixture_dir, name + ".json")) as f:
+        return json.load(f)
+
+
+# Builds a response as the APIs would send it
+def make_response(status_code, body=None, headers=None):
+    content = json.dumps(body).encode("utf8") if body is not None else b""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers["content-type"] = "application/json; charset=utf-8"
+    response.headers["content-length"] = str(len(content))
+    response.headers.update(headers if headers else {})
+    response.request = requests.Request("post", "https://vision.invalid/",
+                                        headers={"Ocp-Apim-Subscription-Key": "benchmark"}).prepare()
+
+    return response
+
+
+# Answers the requests of the bot with the recorded responses instead of sending them
+async def send_fixture_request(service, method, url, headers, **kwargs):
+    if url == bot.comp_vision_analysis_url:
+        return make_response(200, load_fixture("analysis"))
+    elif url == bot.emotion_url:
+        return make_response(200, load_fixture("emotion"))
+    elif kwargs.get("params", {}).get("handwriting"):
+        return make_response(202, headers={"Operation-Location": "https://vision.invalid/operations/1"})
+
+    return make_response(200, load_fixture("ocr"))
+
+
+class FixturePoller(object):
+    async def wait(self, url, headers, key=None):
+        return make_response(200, load_fixture("handwritten"))
+
+
+class FakeMessage(object):
+    message_id = 1
+
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    def reply_document(self, document, **kwargs):
+        self.replies.append(document)
+
+    reply_photo = reply_document
+
+
+class FakeUpdate(object):
+    def __init__(self):
+        self.message = FakeMessage()
+
+
+# Returns a function that runs the image handler on the prepared image and the recorded analysis
+def run_handler(handler, with_result=True):
+    data = samples.make_photo(1600, 1200)
+    analysis = bot.ImageAnalysis.from_json(load_fixture("analysis"))
+
+    def run():
+        user_data = {"msg_id": 1, "image_source": data, "image_data": {"analysis": data, "text": data}}
+
+        if with_result:
+            user_data["image_result"] = analysis
+
+        bot.engine.run(handler.__wrapped__(None, FakeUpdate(), user_data))
+
+    return run
+
+
+@benchmark("image.prepare_jpeg_4000x3000")
+def bench_prepare_jpeg():
+    data = samples.make_photo(4000, 3000)
+
+    return lambda: bot.engine.run(bot.convert_and_read_image(None, None, {"image_source": data}))
+
+
+@benchmark("image.prepare_png_2000x1500")
+def bench_prepare_png():
+    data = samples.make_photo(2000, 1500, "PNG")
+
+    return lambda: bot.engine.run(bot.convert_and_read_image(None, None, {"image_source": data}))
+
+
+@benchmark("image.prepare_text_jpeg_4000x3000")
+def bench_prepare_text_jpeg():
+    data = samples.make_photo(4000, 3000)
+
+    return lambda: bot.engine.run(bot.convert_and_read_image(None, None, {"image_source": data}, "text"))
+
+
+def bench_faces(n):
+    data = samples.make_photo(1600, 1200)
+    faces, emotion_faces = samples.make_faces(n, 1600, 1200)
+    faces = bot.ImageAnalysis.from_json({"faces": faces}).faces
+
+    def run():
+        face_info = bot.merge_faces(faces, emotion_faces)
+        bot.process_image_face(data, emotion_faces, face_info, "#1A6BB2")
+
+    return run
+
+
+for num_faces in (1, 10, 50):
+    benchmark("faces.render_%d" % num_faces)(lambda n=num_faces: bench_faces(n))
+
+
+@benchmark("handler.full_analysis")
+def bench_full_analysis():
+    return run_handler(bot.get_image_full_analysis)
+
+
+@benchmark("handler.category")
+def bench_category():
+    return run_handler(bot.get_image_category)
+
+
+@benchmark("handler.colour")
+def bench_colour():
+    return run_handler(bot.get_image_colour)
+
+
+@benchmark("handler.description")
+def bench_description():
+    return run_handler(bot.get_image_description)
+
+
+@benchmark("handler.face")
+def bench_face():
+    return run_handler(bot.get_image_face)
+
+
+@benchmark("handler.tag")
+def bench_tag():
+    return run_handler(bot.get_image_tag)
+
+
+@benchmark("handler.type")
+def bench_type():
+    return run_handler(bot.get_image_type)
+
+
+@benchmark("handler.normal_text")
+def bench_normal_text():
+    return run_handler(bot.get_image_normal_text)
+
+
+@benchmark("handler.handwritten_text")
+def bench_handwritten_text():
+    return run_handler(bot.get_image_handwritten_text)
+
+
+@benchmark("request.parse_analysis")
+def bench_parse_analysis():
+    response = make_response(200, load_fixture("analysis"))
+
+    return lambda: bot.ImageAnalysis.from_json(bot.parse_response(response)[0])
+
+
+@benchmark("request.process_text")
+def bench_process_text():
+    data = samples.make_photo(1600, 1200)
+    headers = {"Content-Type": "application/octet-stream"}
+    params = {"handwriting": False}
+
+    return lambda: bot.engine.run(bot.process_request("post", bot.comp_vision_text_url, None, data, headers, params))
+
+
+@benchmark("audio.transcode_wav_30s")
+def bench_transcode():
+    if not shutil.which("ffmpeg"):
+        return None
+
+    data = samples.make_speech_wav(30)
+
+    def run():
+        user_data = {"audio_url": "https://audio.invalid/speech.wav", "audio_data": data}
+        bot.engine.run(bot.convert_and_read_audio(None, FakeUpdate(), user_data))
+
+    return run
+
+
+@benchmark("audio.split_segments_60s")
+def bench_split_segments():
+    pcm = bot.engine.run(bot.transcode(bot.engine, samples.make_speech_wav(60))) if shutil.which("ffmpeg") else None
+
+    if not pcm:
+        return None
+
+    return lambda: bot.split_segments(pcm, bot.audio_segment_min_length, bot.audio_segment_max_length)
+
+
+# The language check of the feedback on a mix of the messages users send, against langdetect on its own as before
+@benchmark("language.gate_feedback")
+def bench_language_gate():
+    corpus = load_fixture("feedback")
+    cognitive_lang.load_profiles()
+
+    return lambda: [cognitive_lang.is_accepted_language(x) for x in corpus]
+
+
+@benchmark("language.langdetect_feedback")
+def bench_langdetect():
+    corpus = load_fixture("feedback")
+    cognitive_lang.load_profiles()
+
+    return lambda: [any(x in cognitive_lang.accepted_langs for x in cognitive_lang.detect_langs(text))
+                    for text in corpus]
+
+
+# Returns the peak resident memory of the process in bytes, which Linux reports in KiB and macOS in bytes
+def get_max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+# Returns the resident memory of the process in bytes, or its peak where the current one is not available
+def get_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return get_max_rss()
+
+
+# Times the function over the repeats after a warm up run, and measures how far the runs raise the peak resident
+# memory of the process. The peak Python memory of one more run is measured as well, as tracemalloc does not see the
+# buffers that Pillow and the other native code allocate.
+def measure(func, repeat):
+    gc.collect()
+    rss = get_rss()
+    func()
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    rss = max(0, get_max_rss() - rss)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"mean": sum(times) / len(times), "min": min(times), "peak": peak, "rss": rss}
+
+
+# Runs the benchmark in a process of its own, so that its peak resident memory is not hidden by the earlier ones.
+# Returns its results, or None if it is skipped.
+def run_isolated(name, repeat):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--isolated", name, "-n", str(repeat)],
+                            stdout=subprocess.PIPE, check=True).stdout
+
+    return json.loads(output.decode("utf8").splitlines()[-1])
+
+
+# Sets up and measures the benchmark in this process
+def run_benchmark(name, repeat):
+    func = dict(benchmarks)[name]()
+
+    return measure(func, repeat) if func is not None else None
+
+
+def compare(result, baseline, threshold):
+    changes = []
+
+    for name in ("min", "peak", "rss"):
+        if baseline.get(name):
+            change = result[name] / baseline[name] - 1
+            changes.append("%s %+.0f%%" % (name, change * 100))
+
+            if change > threshold:
+                changes[-1] += " REGRESSION"
+
+    return ", ".join(changes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the benchmarks of the analysis hot paths.")
+    parser.add_argument("-k", "--filter", help="only run the benchmarks with this in their names")
+    parser.add_argument("-n", "--repeat", type=int, default=10, help="timed runs of each benchmark")
+    parser.add_argument("--save", metavar="PATH", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    parser.add_argument("--isolated", metavar="NAME", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    bot.send_request = send_fixture_request
+    bot.poller = FixturePoller()
+
+    # Measures one benchmark for the parent process and prints its results
+    if args.isolated:
+        try:
+            print(json.dumps(run_benchmark(args.isolated, args.repeat)))
+        finally:
+            bot.engine.stop()
+
+        return 0
+
+    baselines = {}
+    results = {}
+    regressed = False
+
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = json.load(f)
+
+    print("%-36s %10s %10s %12s %12s" % ("benchmark", "mean ms", "min ms", "peak KiB", "rss KiB"))
+
+    try:
+        for name, _ in benchmarks:
+            if args.filter and args.filter not in name:
+                continue
+
+            result = run_isolated(name, args.repeat)
+
+            if result is None:
+                print("%-36s skipped" % name)
+                continue
+
+            results[name] = result
+            line = "%-36s %10.3f %10.3f %12.1f %12.1f" % (name, result["mean"] * 1000, result["min"] * 1000,
+                                                          result["peak"] / 1024, result["rss"] / 1024)
+
+            if name in baselines:
+                changes = compare(result, baselines[name], args.threshold)
+                regressed = regressed or "REGRESSION" in changes
+                line += "  " + changes
+
+            print(line)
+    finally:
+        bot.engine.stop()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
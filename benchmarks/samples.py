@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import array
+import io
+import math
+import random
+import wave
+
+from functools import lru_cache
+
+from PIL import Image, ImageDraw
+
+
+# Returns a photo-like image with gradients, noise and shapes, so that it compresses like a real photo
+@lru_cache(maxsize=None)
+def make_photo(width, height, format="JPEG"):
+    size = (width, height)
+    red = Image.linear_gradient("L").resize(size)
+    green = Image.radial_gradient("L").resize(size)
+    blue = Image.effect_noise(size, 48)
+    im = Image.merge("RGB", (red, green, blue))
+    draw = ImageDraw.Draw(im)
+    rand = random.Random(width * height)
+
+    for _ in range(40):
+        x, y = rand.randrange(width), rand.randrange(height)
+        radius = rand.randrange(min(size) // 40, min(size) // 8)
+        colour = tuple(rand.randrange(256) for _ in range(3))
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=colour)
+
+    if format == "PNG":
+        im.putalpha(Image.radial_gradient("L").resize(size))
+
+    buf = io.BytesIO()
+    im.save(buf, format, quality=92)
+
+    return buf.getvalue()
+
+
+# Returns a WAV of tone bursts separated by pauses, roughly the rhythm of speech
+@lru_cache(maxsize=None)
+def make_speech_wav(seconds, sample_rate=44100, channels=2):
+    rand = random.Random(seconds)
+    syllable = array.array("h", (int(8000 * math.sin(2 * math.pi * 220 * i / sample_rate))
+                                 for i in range(sample_rate // 5)))
+    silence = array.array("h", bytes(sample_rate // 5 * 2))
+    samples = array.array("h")
+
+    while len(samples) < seconds * sample_rate:
+        for _ in range(rand.randrange(2, 8)):
+            samples.extend(syllable)
+
+        for _ in range(rand.randrange(1, 4)):
+            samples.extend(silence)
+
+    del samples[seconds * sample_rate:]
+
+    if channels == 2:
+        stereo = array.array("h", bytes(len(samples) * 4))
+        stereo[0::2] = samples
+        stereo[1::2] = samples
+        samples = stereo
+
+    buf = io.BytesIO()
+
+    with wave.open(buf, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+    return buf.getvalue()
+
+
+# Returns the faces found by the Computer Vision and Emotion APIs for n faces laid out in a grid
+def make_faces(n, width, height):
+    columns = math.ceil(math.sqrt(n))
+    rows = math.ceil(n / columns)
+    size = min(width // columns, height // rows) * 2 // 3
+    emotions = ("anger", "contempt", "disgust", "fear", "happiness", "neutral", "sadness", "surprise")
+    faces = []
+    emotion_faces = []
+
+    for i in range(n):
+        left = (i % columns) * width // columns + size // 4
+        top = (i // columns) * height // rows + size // 4
+        faces.append({"age": 20 + i % 50, "gender": "Female" if i % 2 else "Male",
+                      "faceRectangle": {"left": left, "top": top, "width": size, "height": size}})
+        scores = {x: 0.01 for x in emotions}
+        scores[emotions[i % len(emotions)]] = 0.93
+        emotion_faces.append({"faceRectangle": {"left": left + 2, "top": top + 3, "width": size - 4,
+                                                "height": size - 4}, "scores": scores})
+
+    return faces, emotion_faces
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class Album(object):
+    __slots__ = ("group_id", "items", "updated")
+
+    def __init__(self, group_id, items, updated):
+        self.group_id = group_id
+        self.items = items
+        self.updated = updated
+
+
+# Groups the images of an album. Telegram marks them with a media group id, and the images of a chat that arrive
+# within the window of each other are grouped when it is not available.
+class AlbumCollector(object):
+    def __init__(self, window=2, max_chats=10000):
+        self.window = window
+        self.max_chats = max_chats
+        self._albums = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Adds the item to the album of the chat, returns the items of the album and if the item started it. Without
+    # start, the item is only added to an album that has been started already.
+    def add(self, chat_id, group_id, item, start=True):
+        now = time.monotonic()
+
+        with self._lock:
+            self._prune(now)
+            album = self._albums.get(chat_id)
+
+            if album is not None and (album.group_id == group_id if group_id is not None else
+                                      album.group_id is None and now - album.updated <= self.window):
+                album.items.append(item)
+                album.updated = now
+                self._albums.move_to_end(chat_id)
+
+                return album.items, False
+
+            if not start:
+                return None, False
+
+            self._albums.pop(chat_id, None)
+
+            if len(self._albums) >= self.max_chats:
+                self._albums.popitem(last=False)
+
+            self._albums[chat_id] = Album(group_id, [item], now)
+
+            return self._albums[chat_id].items, True
+
+    # Hands the items of the album over to the task, removing the album of the chat if it holds them. The task gets a
+    # copy, so that the images it downloads into the items are not kept by the collector.
+    def release(self, chat_id, items):
+        with self._lock:
+            album = self._albums.get(chat_id)
+
+            if album is not None and album.items is items:
+                del self._albums[chat_id]
+
+            return [dict(x) for x in items]
+
+    # Removes the albums whose window has closed, which are the oldest ones
+    def _prune(self, now):
+        while self._albums:
+            album = next(iter(self._albums.values()))
+
+            if now - album.updated <= self.window:
+                break
+
+            self._albums.popitem(last=False)
+
+
+# Stands in for the message of an album image, collecting the replies of the task instead of sending them
+class AlbumMessage(object):
+    def __init__(self, message):
+        self.message = message
+        self.texts = []
+        self.images = []
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    # The status messages and the keyboard prompts come with a reply markup, the album sends its own
+    def reply_text(self, text, reply_markup=None, **kwargs):
+        if reply_markup is None:
+            self.texts.append(text)
+
+    def reply_document(self, document, caption=None, **kwargs):
+        self.images.append((document, caption))
+
+    reply_photo = reply_document
+
+
+class AlbumUpdate(object):
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+import audioop
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+pcm_sample_rate = 16000
+pcm_sample_width = 2
+
+
+# Returns the ffmpeg command that decodes the input into 16 kHz mono 16-bit PCM on stdout
+def get_transcode_args(input_path="pipe:0"):
+    return ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", input_path, "-f", "s16le", "-acodec", "pcm_s16le",
+            "-ac", "1", "-ar", str(pcm_sample_rate), "pipe:1"]
+
+
+# Transcodes the audio through ffmpeg's stdin and stdout on the engine, returns the PCM or None if it fails
+async def transcode(engine, data):
+    returncode, out, err = await engine.run_process("ffmpeg", get_transcode_args(), data)
+
+    if returncode == 0 and out:
+        return out
+
+    # MP4 files with the index at the end can't be read from a pipe as ffmpeg needs to seek
+    if data[4:8] == b"ftyp":
+        returncode, out, err = await _transcode_file(engine, data)
+
+        if returncode == 0 and out:
+            return out
+
+    logger.error("Failed to transcode audio: %s" % err.decode("utf8", "replace").strip())
+
+    return None
+
+
+async def _transcode_file(engine, data):
+    fd, path = tempfile.mkstemp(suffix=".m4a")
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        return await engine.run_process("ffmpeg", get_transcode_args(path))
+    finally:
+        os.remove(path)
+
+
+# Splits the PCM into segments of at most max_length seconds.
+# Each cut is made at the quietest point between min_length and max_length seconds into the segment.
+def split_segments(pcm, min_length=4, max_length=14, frame_length=0.03, window=5):
+    if len(pcm) <= max_length * pcm_sample_rate * pcm_sample_width:
+        return [pcm]
+
+    frame_size = int(frame_length * pcm_sample_rate) * pcm_sample_width
+    min_frames = int(min_length / frame_length)
+    max_frames = int(max_length / frame_length)
+    num_frames = len(pcm) // frame_size
+    energies = [audioop.rms(pcm[i * frame_size:(i + 1) * frame_size], pcm_sample_width) for i in range(num_frames)]
+
+    # Smooths the energy over a few frames so that a cut falls in a pause rather than between two syllables
+    loudness = []
+    total = 0
+
+    for i, energy in enumerate(energies):
+        total += energy
+
+        if i >= window:
+            total -= energies[i - window]
+
+        loudness.append(total)
+
+    segments = []
+    start = 0
+
+    while num_frames - start > max_frames:
+        quietest = min(range(start + min_frames, start + max_frames), key=lambda x: (loudness[x], -x))
+        cut = quietest - window // 2
+        segments.append(pcm[start * frame_size:cut * frame_size])
+        start = cut
+
+    segments.append(pcm[start * frame_size:])
+
+    return segments
@@ -1,27 +1,53 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import asyncio
 import dotenv
-import langdetect
+import importlib
+import io
+import json
 import logging
 import mimetypes
-import operator
 import os
-import re
-import requests
-import shlex
-import smtplib
-import speech_recognition as sr
+import signal
+import threading
 import time
 
-from PIL import Image, ImageDraw, ImageFont
-from subprocess import Popen, PIPE
+from contextlib import contextmanager
+from functools import wraps
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ReplyKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, RegexHandler
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ReplyKeyboardMarkup, \
+    ReplyKeyboardRemove, Update
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.ext import Updater, CommandHandler, ConversationHandler, MessageHandler, Filters, RegexHandler, \
+    TypeHandler
 from telegram.ext.dispatcher import run_async
 
+from cognitive_album import AlbumCollector, AlbumMessage, AlbumUpdate
+from cognitive_audio import pcm_sample_rate, pcm_sample_width, split_segments, transcode
+from cognitive_cache import BlobCache, ResultCache, make_key
 from cognitive_cov_states import *
+from cognitive_engine import AsyncEngine
+from cognitive_flight import SingleFlight
+from cognitive_format import format_categories, format_colour, format_description, format_image_type, format_summary, \
+    format_tags, format_text
+from cognitive_http import HttpClient
+from cognitive_image import is_image_error, prepare_image
+from cognitive_ingest import fetch_url, FETCH_FAILED, FETCH_OK, FETCH_TOO_LARGE, FETCH_UNSUPPORTED
+from cognitive_keys import KeyPool, parse_keys
+from cognitive_lang import is_accepted_language, load_profiles
+from cognitive_lazy import WarmUp, lazy_import
+from cognitive_mail import Mailer
+from cognitive_metrics import MetricsRegistry, MetricsServer
+from cognitive_poller import OperationPoller
+from cognitive_render import FaceRenderer
+from cognitive_results import ImageAnalysis, TextResult
+from cognitive_shard import ShardRouter
+from cognitive_state import MemoryBackend, SQLiteBackend, StateStore, conversation_state
+from cognitive_trace import Tracer
+
+# The modules that only some of the tasks need are imported on first use, or by the warm up
+sr = lazy_import("speech_recognition")
 
 # Enable logging
 logging.basicConfig(format="[%(asctime)s] [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %I:%M:%S %p",
@@ -32,6 +58,9 @@ dotenv_path = os.path.join(os.path.dirname(__file__), ".env")
 dotenv.load(dotenv_path)
 app_url = os.environ.get("APP_URL")
 port = int(os.environ.get("PORT", "5000"))
+metrics_port = int(os.environ.get("METRICS_PORT", str(port + 1)))
+dispatcher_processes = int(os.environ.get("DISPATCHER_PROCESSES", "1"))
+warm_up_mode = os.environ.get("WARM_UP", "background")
 
 telegram_token = os.environ.get("TELEGRAM_TOKEN_BETA") if os.environ.get("TELEGRAM_TOKEN_BETA") \
     else os.environ.get("TELEGRAM_TOKEN")
@@ -40,16 +69,144 @@ dev_email = os.environ.get("DEV_EMAIL") if os.environ.get("DEV_EMAIL") else "sam
 dev_email_pw = os.environ.get("DEV_EMAIL_PW")
 is_email_feedback = os.environ.get("IS_EMAIL_FEEDBACK")
 smtp_host = os.environ.get("SMTP_HOST")
+smtp_port = int(os.environ.get("SMTP_PORT", "0"))
+smtp_starttls = os.environ.get("SMTP_STARTTLS", "true").lower() not in ("0", "false", "no")
+mail_batch_window = float(os.environ.get("MAIL_BATCH_WINDOW", "5"))
+mail_max_batch = int(os.environ.get("MAIL_MAX_BATCH", "50"))
+mail_retries = int(os.environ.get("MAIL_RETRIES", "5"))
 
-comp_vision_token = os.environ.get("COMP_VISION_TOKEN")
 comp_vision_analysis_url = os.environ.get("COMP_VISION_ANALYSIS_URL")
 comp_vision_text_url = os.environ.get("COMP_VISION_TEXT_URL")
-emotion_token = os.environ.get("EMOTION_TOKEN")
 emotion_url = os.environ.get("EMOTION_URL")
-bing_speech_token = os.environ.get("BING_SPEECH_TOKEN")
+
+key_rate = float(os.environ.get("KEY_RATE", "10"))
+key_cooldown = float(os.environ.get("KEY_COOLDOWN", "60"))
+key_max_cooldown = float(os.environ.get("KEY_MAX_COOLDOWN", "3600"))
+
+result_cache_size = int(os.environ.get("RESULT_CACHE_SIZE", "1000"))
+result_cache_ttl = int(os.environ.get("RESULT_CACHE_TTL", "86400"))
+result_cache_dir = os.environ.get("RESULT_CACHE_DIR")
+result_cache_disk_size = int(os.environ.get("RESULT_CACHE_DISK_SIZE", "100000000"))
+
+file_cache_size = int(os.environ.get("FILE_CACHE_SIZE", "50000000"))
+file_cache_ttl = int(os.environ.get("FILE_CACHE_TTL", "86400"))
+file_cache_dir = os.environ.get("FILE_CACHE_DIR")
+file_cache_disk_size = int(os.environ.get("FILE_CACHE_DISK_SIZE", "500000000"))
+
+image_session_ttl = int(os.environ.get("IMAGE_SESSION_TTL", "600"))
+image_quality = int(os.environ.get("IMAGE_QUALITY", "85"))
+face_image_quality = int(os.environ.get("FACE_IMAGE_QUALITY", "85"))
+face_image_max_size = int(os.environ.get("FACE_IMAGE_MAX_SIZE", "1280"))
+face_image_as_photo = os.environ.get("FACE_IMAGE_AS_PHOTO")
+image_profiles = {"analysis": int(os.environ.get("IMAGE_ANALYSIS_MAX_SIZE", "1024")),
+                  "text": int(os.environ.get("IMAGE_TEXT_MAX_SIZE", "3200"))}
+
+http_pool_size = int(os.environ.get("HTTP_POOL_SIZE", "10"))
+http_retries = int(os.environ.get("HTTP_RETRIES", "3"))
+http_timeout = float(os.environ.get("HTTP_TIMEOUT", "30"))
+ingest_hosts = int(os.environ.get("INGEST_HOSTS", "50"))
+
+ocr_poll_interval = float(os.environ.get("OCR_POLL_INTERVAL", "1"))
+ocr_poll_max_interval = float(os.environ.get("OCR_POLL_MAX_INTERVAL", "10"))
+ocr_poll_timeout = float(os.environ.get("OCR_POLL_TIMEOUT", "120"))
+
+audio_segment_min_length = float(os.environ.get("AUDIO_SEGMENT_MIN_LENGTH", "4"))
+audio_segment_max_length = float(os.environ.get("AUDIO_SEGMENT_MAX_LENGTH", "14"))
+
+album_window = float(os.environ.get("ALBUM_WINDOW", "2"))
+
+state_backend = os.environ.get("STATE_BACKEND", "memory")
+state_db = os.environ.get("STATE_DB", "state.db")
+state_idle_timeout = float(os.environ.get("STATE_IDLE_TIMEOUT", "86400"))
+state_flush_interval = float(os.environ.get("STATE_FLUSH_INTERVAL", "1"))
+state_batch_size = int(os.environ.get("STATE_BATCH_SIZE", "100"))
+
+trace_slow_threshold = float(os.environ.get("TRACE_SLOW_THRESHOLD", "10"))
+trace_log = os.environ.get("TRACE_LOG", "slow_updates.log")
+trace_profile_interval = float(os.environ.get("TRACE_PROFILE_INTERVAL", "0.01"))
+
+engine_workers = int(os.environ.get("ENGINE_WORKERS", "32"))
+engine_limits = {"vision": int(os.environ.get("VISION_CONCURRENCY", "16")),
+                 "emotion": int(os.environ.get("EMOTION_CONCURRENCY", "16")),
+                 "speech": int(os.environ.get("SPEECH_CONCURRENCY", "8")),
+                 "download": int(os.environ.get("DOWNLOAD_CONCURRENCY", "16")),
+                 "ffmpeg": int(os.environ.get("FFMPEG_CONCURRENCY", str(os.cpu_count() or 1))),
+                 "album": int(os.environ.get("ALBUM_CONCURRENCY", "4"))}
 
 cognitive_image_size_limit = 4000000
-clip_art_types = {0: "non-clip-art", 1: "ambiguous", 2: "normal-clip-art", 3: "good-clip-art"}
+image_size_limit = 20000000
+cognitive_audio_size_limit = 20000000
+image_features = "Categories, Tags, Description, Faces, ImageType, Color"
+image_details = "Celebrities, Landmarks"
+face_overlap_threshold = 0.5
+
+# Files are kept out of the saved user data as they can be downloaded again
+transient_user_data = ("image_source", "image_data", "audio_data")
+
+# Latency of each stage and handler, upstream status codes, cache hits and requests in flight
+metrics = MetricsRegistry()
+stage_latency = metrics.histogram("cognitive_stage_seconds", "Latency of each stage of the tasks", ("stage",))
+handler_latency = metrics.histogram("cognitive_handler_seconds", "Latency of each task handler", ("handler",))
+handler_errors = metrics.counter("cognitive_handler_errors_total", "Task handlers that failed", ("handler",))
+upstream_responses = metrics.counter("cognitive_upstream_responses_total", "Responses of the APIs by status code",
+                                     ("service", "code"))
+cache_requests = metrics.counter("cognitive_cache_requests_total", "Cache lookups by result", ("cache", "result"))
+in_flight_requests = metrics.gauge("cognitive_in_flight_requests", "Requests to the APIs in flight", ("service",))
+
+# Traces each update and logs the slow ones
+tracer = Tracer(trace_slow_threshold, trace_log, trace_profile_interval)
+
+# Conversation states and user data, dropped once idle and saved to SQLite if configured
+state_store = StateStore(SQLiteBackend(state_db) if state_backend == "sqlite" else MemoryBackend(), state_idle_timeout,
+                         state_flush_interval, state_batch_size)
+
+# Results of the image analysis endpoints, keyed by the image bytes and request params
+result_cache = ResultCache(result_cache_size, result_cache_ttl, result_cache_dir, result_cache_disk_size)
+
+# Files downloaded from Telegram, keyed by the file so that a file sent again is not downloaded again
+file_cache = BlobCache(file_cache_size, file_cache_ttl, file_cache_dir, file_cache_disk_size)
+
+# Keeps the annotation font loaded between the face analyses
+face_renderer = FaceRenderer(face_image_quality, face_image_max_size)
+
+# Subscription keys of each service, each limited to the rate of its tier
+key_pools = {"vision": KeyPool(parse_keys(os.environ.get("COMP_VISION_TOKEN"), key_rate), key_cooldown,
+                               key_max_cooldown),
+             "emotion": KeyPool(parse_keys(os.environ.get("EMOTION_TOKEN"), key_rate), key_cooldown,
+                                key_max_cooldown),
+             "speech": KeyPool(parse_keys(os.environ.get("BING_SPEECH_TOKEN"), key_rate), key_cooldown,
+                               key_max_cooldown)}
+speech_error_codes = {"Forbidden": 403, "Too Many Requests": 429}
+speech_recognizers = {}
+audio_gap_marker = "[…could not recognise part of the audio…]"
+
+# Shared connection pool for all the outbound requests
+http = HttpClient(pool_size=http_pool_size, retries=http_retries, timeout=http_timeout)
+
+# Downloads the files of the URLs that users send, kept apart so that their hosts do not push the API hosts out of the
+# connection pools of the shared client
+ingest_http = HttpClient(pool_size=http_pool_size, num_hosts=ingest_hosts, retries=http_retries, timeout=http_timeout,
+                         cookies=False)
+
+# Event loop that runs the image and audio tasks without blocking the dispatcher
+engine = AsyncEngine(http, engine_limits, engine_workers)
+
+# Shares the downloads and requests that are in flight for the same file or image
+flights = SingleFlight()
+
+# Groups the images that are sent together as an album
+albums = AlbumCollector(album_window)
+
+# Polls the handwritten text operations of all users
+poller = OperationPoller(engine, interval=ocr_poll_interval, max_interval=ocr_poll_max_interval,
+                         timeout=ocr_poll_timeout, pool=key_pools["vision"])
+
+# Emails the feedback to the developer in the background
+mailer = Mailer(smtp_host, smtp_port, smtp_starttls, dev_email, dev_email_pw, dev_email, dev_email,
+                "Telegram Cognitive Bot Feedback", mail_batch_window, mail_max_batch, mail_retries)
+
+# Loads the slow pieces before the first user needs them, the bot is ready once it has finished
+warm_up = WarmUp()
 
 
 def main():
@@ -58,16 +215,20 @@ def main():
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
-    # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help))
-    dp.add_handler(CommandHandler("donate", donate))
-    dp.add_handler(file_cov_handler())
-    dp.add_handler(feedback_cov_handler())
-    dp.add_handler(CommandHandler("send", send, pass_args=True))
+    router = None
+
+    # Hands the updates to the worker processes by chat, or handles them in this process
+    if dispatcher_processes > 1:
+        router = ShardRouter(dispatcher_processes, run_worker)
+        router.start()
+        dp.add_handler(TypeHandler(Update, lambda bot, update: router.route(get_shard_key(update), update)))
+        dp.add_error_handler(error)
+    else:
+        setup_dispatcher(dp)
+        start_services(metrics_port)
 
-    # log all errors
-    dp.add_error_handler(error)
+        if warm_up_mode == "blocking":
+            start_warm_up(updater.bot)
 
     # Start the Bot
     if app_url:
@@ -78,11 +239,126 @@ def main():
     else:
         updater.start_polling()
 
+    if not router and warm_up_mode != "blocking":
+        start_warm_up(updater.bot)
+
     # Run the bot until the you presses Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    if router:
+        router.stop()
+    else:
+        stop_services()
+
+
+# Registers the handlers
+def setup_dispatcher(dp):
+    dp.user_data = state_store.mapping("user_data", dict, get_saved_user_data)
+    # on different commands - answer in Telegram
+    dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("help", help))
+    dp.add_handler(CommandHandler("donate", donate))
+    dp.add_handler(file_cov_handler())
+    dp.add_handler(feedback_cov_handler())
+    dp.add_handler(CommandHandler("send", send, pass_args=True))
+
+    # log all errors
+    dp.add_error_handler(error)
+
+
+def start_services(service_metrics_port):
+    state_store.start()
+    engine.start()
+
+    if is_email_feedback:
+        mailer.start()
+
+    if service_metrics_port:
+        MetricsServer(metrics, service_metrics_port, ready=lambda: warm_up.ready).start()
+
+
+def stop_services():
+    engine.stop()
+    state_store.close()
+    mailer.close()
+
+
+# Warms up the language profiles, Pillow and the fonts, speech recognition and the connections, in the background
+# unless the mode is blocking, or skips it if the mode is off
+def start_warm_up(bot):
+    if warm_up_mode == "off":
+        warm_up.skip()
+
+        return
+
+    warm_up.add("language profiles", load_profiles)
+    warm_up.add("fonts", face_renderer.warm_up)
+    warm_up.add("image modules", load_image_modules)
+    warm_up.add("speech recognition", sr.load)
+    warm_up.add("API connections", http.warm_up, [comp_vision_analysis_url, comp_vision_text_url, emotion_url])
+    warm_up.add("Telegram connection", bot.get_me)
+    warm_up.start(blocking=warm_up_mode == "blocking")
+
+
+# Imports Pillow and its image plugins, which it otherwise does on the first image
+def load_image_modules():
+    for name in ("PIL.ImageOps", "PIL.ImageDraw"):
+        importlib.import_module(name)
+
+    importlib.import_module("PIL.Image").init()
+
+
+# Returns the key that the updates are sharded by, which is the chat id, or the user id for updates without a chat
+def get_shard_key(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    elif update.effective_user:
+        return update.effective_user.id
+
+    return update.update_id
+
+
+# Handles the updates of the chats that the main process hands to this worker process
+def run_worker(index, queue):
+    # The main process stops the workers once it has stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    updater = Updater(telegram_token)
+    setup_dispatcher(updater.dispatcher)
+    start_services(metrics_port + index if metrics_port else 0)
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher")
+    dispatcher_thread.start()
+    start_warm_up(updater.bot)
+
+    while True:
+        data = queue.get()
+
+        if data is None:
+            break
+
+        updater.update_queue.put(Update.de_json(json.loads(data), updater.bot))
+
+    while not updater.update_queue.empty():
+        time.sleep(0.1)
+
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+    dispatcher_thread.join()
+    stop_services()
+
+
+# Returns the user data to save, without the files
+def get_saved_user_data(user_data):
+    saved = {key: value for key, value in user_data.items() if key not in transient_user_data}
+
+    if "album" in saved:
+        saved["album"] = [get_saved_user_data(x) for x in saved["album"]]
+
+    return saved
+
 
 # Sends start message
 @run_async
@@ -129,7 +405,7 @@ def file_cov_handler():
                      Filters.voice) & (~Filters.forwarded | Filters.forwarded)
 
     conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(merged_filter, check_file, pass_user_data=True)],
+        entry_points=[MessageHandler(merged_filter, check_file, pass_user_data=True, pass_job_queue=True)],
 
         states={
             WAIT_IMAGE_TASK: [RegexHandler("^Full Analysis$", get_image_full_analysis, pass_user_data=True),
@@ -144,18 +420,48 @@ def file_cov_handler():
             WAIT_AUDIO_TASK: [RegexHandler("^To Text", audio_to_text, pass_user_data=True)],
         },
 
-        fallbacks=[CommandHandler("cancel", cancel), RegexHandler("^[Cc]ancel$", cancel)],
+        fallbacks=[CommandHandler("cancel", cancel_file, pass_user_data=True),
+                   RegexHandler("^[Cc]ancel$", cancel_file, pass_user_data=True)],
 
         allow_reentry=True
     )
+    conv_handler.conversations = state_store.mapping("file_conversations", persist=conversation_state)
 
     return conv_handler
 
 
+# Records the latency of the stage and adds its span to the trace of the update
+@contextmanager
+def stage(name, **attrs):
+    with stage_latency.time(name), tracer.span(name, **attrs):
+        yield
+
+
+# Traces the handler as an update
+def traced(func):
+    @wraps(func)
+    def wrapper(bot, update, *args, **kwargs):
+        with tracer.trace(func.__name__, chat_id=update.message.chat_id, msg_id=update.message.message_id):
+            return func(bot, update, *args, **kwargs)
+
+    return wrapper
+
+
 # Checks for the document or image or audio received
-def check_file(bot, update, user_data):
+@run_async
+@traced
+def check_file(bot, update, user_data, job_queue):
+    # The other images of an album are run along with the first one, which holds the conversation
+    album, is_first = add_to_album(update)
+
+    if album and not is_first:
+        return WAIT_IMAGE_TASK
+
     file_type = None
     return_type = ConversationHandler.END
+    clear_image(user_data)
+    user_data.pop("audio_data", None)
+    user_data.pop("file_key", None)
 
     if update.message.document:
         file_type = "doc"
@@ -171,9 +477,11 @@ def check_file(bot, update, user_data):
         doc_name = doc.file_name
         doc_size = doc.file_size
         mimetype = mimetypes.guess_type(doc_name)[0]
+        user_data["file_key"] = get_file_key(doc)
+        tracer.annotate(file_type=mimetype, file_size=doc_size)
 
         if mimetype.startswith("image"):
-            if doc_size > cognitive_image_size_limit:
+            if doc_size > image_size_limit:
                 update.message.reply_text("The file you sent is too large for me to process. Sorry.")
 
                 return ConversationHandler.END
@@ -186,58 +494,65 @@ def check_file(bot, update, user_data):
     elif file_type == "image":
         image = update.message.photo[-1]
         image_size = image.file_size
+        tracer.annotate(file_type="photo", file_size=image_size)
 
-        if image_size > cognitive_image_size_limit:
+        if image_size > image_size_limit:
             update.message.reply_text("The photo you sent is too large for me to process. Sorry.")
 
             return ConversationHandler.END
 
         user_data["image_id"] = image.file_id
+        user_data["file_key"] = get_file_key(image)
         return_type = WAIT_IMAGE_TASK
     elif file_type == "audio":
         audio = update.message.audio if update.message.audio else update.message.voice
         user_data["audio_id"] = audio.file_id
+        user_data["file_key"] = get_file_key(audio)
+        tracer.annotate(file_type="audio", file_size=audio.file_size)
         return_type = WAIT_AUDIO_TASK
 
     # Checks for received URL
     else:
         file_url = update.message.text
-        mimetype = mimetypes.guess_type(file_url)[0]
-        response = requests.get(file_url)
 
-        # If URL does not give an image or audio, ends the conversation
-        if mimetype.startswith("image") or mimetype.startswith("audio"):
-            if response.status_code not in range(200, 209):
-                update.message.reply_text("I could not retrieve the file from the URL you sent me. Please try again.")
+        # Downloads the file once and keeps it for the task
+        with stage("fetch_url"):
+            status, file_type, data = fetch_url(ingest_http, file_url, {"image": image_size_limit,
+                                                                 "audio": cognitive_audio_size_limit})
 
-                return ConversationHandler.END
+        tracer.annotate(file_type=file_type, file_size=len(data) if data else None)
 
-            if mimetype.startswith("image"):
-                if int(response.headers["content-length"]) > cognitive_image_size_limit:
-                    update.message.reply_text("The image on the URL you sent me is too large for me to process. Sorry.")
+        # If URL does not give an image or audio, ends the conversation
+        if status == FETCH_UNSUPPORTED:
+            return ConversationHandler.END
+        elif status == FETCH_FAILED:
+            update.message.reply_text("I could not retrieve the file from the URL you sent me. Please try again.")
 
-                    return ConversationHandler.END
+            return ConversationHandler.END
+        elif status == FETCH_TOO_LARGE:
+            update.message.reply_text("The %s on the URL you sent me is too large for me to process. Sorry." %
+                                      file_type)
 
-                user_data["image_url"] = file_url
-                return_type = WAIT_IMAGE_TASK
-            elif mimetype.startswith("audio"):
-                user_data["audio_url"] = file_url
-                return_type = WAIT_AUDIO_TASK
-        else:
             return ConversationHandler.END
 
+        if file_type == "image":
+            user_data["image_url"] = file_url
+            user_data["image_source"] = data
+            return_type = WAIT_IMAGE_TASK
+        else:
+            user_data["audio_url"] = file_url
+            user_data["audio_data"] = data
+            return_type = WAIT_AUDIO_TASK
+
     user_data["msg_id"] = update.message.message_id
 
     if return_type == WAIT_IMAGE_TASK:
-        keywords = sorted(["Categories", "Tags", "Description", "Faces", "Image Type", "Colour", "Text (Normal)",
-                           "Text (Handwritten)"])
-        keyboard_size = 3
-        keyboard = [keywords[i:i + keyboard_size] for i in range(0, len(keywords), keyboard_size)]
-        keyboard.append(["Full Analysis", "Cancel"])
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+        if album:
+            user_data["album"] = album
 
-        update.message.reply_text("Please tell me what do you want me to look for on the image.",
-                                  reply_markup=reply_markup)
+        # Keeps the image for the session so that the user can run multiple tasks on it
+        job_queue.run_once(expire_image, image_session_ttl, context=(user_data, user_data["msg_id"]))
+        ask_image_task(update, "Please tell me what do you want me to look for on the image.")
     elif return_type == WAIT_AUDIO_TASK:
         keyboard = [["To Text"], ["Cancel"]]
         reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
@@ -248,760 +563,798 @@ def check_file(bot, update, user_data):
     return return_type
 
 
-# Fully analysis an image
-def get_image_full_analysis(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+# Adds the image of the message to the album of the chat, returns the images of the album and if it is the first one
+def add_to_album(update):
+    message = update.message
 
-    update.message.reply_text("Analysing the image.", reply_markup=ReplyKeyboardRemove())
+    if message.photo:
+        image = message.photo[-1]
+    elif message.document and (mimetypes.guess_type(message.document.file_name)[0] or "").startswith("image"):
+        image = message.document
+    else:
+        return None, False
 
-    tele_id = update.message.from_user.id
-    msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_full"
-    out_image_name = image_name + "_done"
-    accent_colour = None
-    face_info = {}
+    item = {"image_id": image.file_id, "file_key": get_file_key(image), "msg_id": message.message_id}
+    too_large = image.file_size > image_size_limit
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "Categories, Tags, Description, Faces, ImageType, Color",
-              "details": "Celebrities, Landmarks"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, comp_vision_err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+    # An image that is too large is reported with the album, or on its own if it is the first image
+    if too_large:
+        item["too_large"] = True
 
-    if result:
-        text = "Here is a summary of it:\n\n"
-        num_categories = len(result["categories"])
-        num_tags = len(result["tags"])
-        target_landmark = None
-        target_caption = None
-        max_landmark_conf = 0
-        max_caption_conf = 0
-
-        if num_categories == 1:
-            text += "Category: "
-        else:
-            text += "Categories: "
+    return albums.add(message.chat_id, getattr(message, "media_group_id", None), item, start=not too_large)
 
-        # Gets categories info
-        for i, category in enumerate(result["categories"]):
-            name = category["name"].rstrip("_")
-            name = re.sub("_", " ", name)
 
-            if i == (num_categories - 2):
-                text += name + " and "
-            elif i == (num_categories - 1):
-                text += name + "\n"
-            else:
-                text += name + ", "
+# Returns the key that identifies the file across messages, which is the unique file id if Telegram provides it
+def get_file_key(telegram_file):
+    return getattr(telegram_file, "file_unique_id", None) or telegram_file.file_id
 
-            # Gets landmarks info if exists
-            if "detail" in category and "landmarks" in category["detail"]:
-                for landmark in category["detail"]["landmarks"]:
-                    landmark_name, landmark_conf = landmark["name"], landmark["confidence"]
 
-                    if landmark_conf > max_landmark_conf:
-                        target_landmark = landmark_name
-                        max_landmark_conf = landmark_conf
+# Asks the user for the next task on the image
+def ask_image_task(update, text="Is there anything else you want me to look for on the image?"):
+    keywords = sorted(["Categories", "Tags", "Description", "Faces", "Image Type", "Colour", "Text (Normal)",
+                       "Text (Handwritten)"])
+    keyboard_size = 3
+    keyboard = [keywords[i:i + keyboard_size] for i in range(0, len(keywords), keyboard_size)]
+    keyboard.append(["Full Analysis", "Cancel"])
+    reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
 
-        if num_tags == 1:
-            text += "Tag: "
-        else:
-            text += "Tags: "
+    update.message.reply_text(text, reply_markup=reply_markup)
 
-        # Gets tags info
-        for i, category in enumerate(result["tags"]):
-            tag_name = "#" + category["name"].rstrip("_")
-            tag_name = re.sub(" ", "", tag_name)
+    return WAIT_IMAGE_TASK
 
-            if i == (num_tags - 2):
-                text += tag_name + " and "
-            elif i == (num_tags - 1):
-                text += tag_name + "\n\n"
-            else:
-                text += tag_name + ", "
 
-        # Gets description
-        if target_landmark:
-            text += "Description: it's the %s.\n\n" % target_landmark
+# Runs the image task on the engine and waits for the next task straight away
+def image_task(func):
+    @wraps(func)
+    def wrapper(bot, update, user_data):
+        if not has_image(update, user_data):
+            return ConversationHandler.END
+
+        if len(user_data.get("album", ())) > 1:
+            coro = run_album_task(func, bot, update, user_data)
         else:
-            for caption in result["description"]["captions"]:
-                caption_text, caption_conf = caption["text"], caption["confidence"]
+            coro = func(bot, update, user_data)
 
-                if caption_conf > max_caption_conf:
-                    target_caption = caption_text
-                    max_caption_conf = caption_conf
+        engine.submit(run_task(func.__name__, update, user_data, coro, image=True))
 
-            text += "Description: it's %s.\n\n" % target_caption
+        return WAIT_IMAGE_TASK
 
-        image_type = result["imageType"]
-        clip_art_type, line_drawing_type = image_type["clipArtType"], image_type["lineDrawingType"]
-        clip_art_type = clip_art_types[clip_art_type]
-        text += "Clip art type: %s\n" % clip_art_type
+    return wrapper
 
-        if line_drawing_type:
-            text += "Line drawing: yes\n\n"
-        else:
-            text += "Line drawing: no\n\n"
-
-        # Gets colour info
-        colour = result["color"]
-        foreground_colour = colour["dominantColorForeground"].lower()
-        background_colour = colour["dominantColorBackground"].lower()
-        accent_colour = "#" + colour["accentColor"]
-        is_bw = colour["isBWImg"]
-        dominant_colours = ", ".join(map(str.lower, colour["dominantColors"]))
-
-        if is_bw:
-            text += "Black and white image: yes\n"
-        else:
-            text += "Black and white image: no\n"
-
-        text += "Foreground dominant colour: %s\n" % foreground_colour
-        text += "Background dominant colour: %s\n" % background_colour
-        text += "Dominant colours: %s\n" % dominant_colours
-        text += "Accent colour: %s\n\n" % accent_colour
-        text += "I am still analysing the faces on the image. You can look at the summary while you are waiting."
-
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-
-        # Stores face info for emotion analysis
-        for face in result["faces"]:
-            age, gender = face["age"], face["gender"]
-            face_rectangle = face["faceRectangle"]
-            left = face_rectangle["left"]
-            top = face_rectangle["top"]
-            width = face_rectangle["width"]
-            height = face_rectangle["height"]
-
-            face_info[(left, top, width, height)] = (age, gender)
-    elif not comp_vision_err_msg:
-        update.message.reply_text("Something went wrong. Please try again.")
 
-        if os.path.exists(image_name):
-            os.remove(image_name)
-        if os.path.exists(out_image_name):
-            os.remove(out_image_name)
+# Runs the audio task on the engine and ends the conversation straight away
+def audio_task(func):
+    @wraps(func)
+    def wrapper(bot, update, user_data):
+        if not user_data.get("audio_id") and not user_data.get("audio_url"):
+            return ConversationHandler.END
+
+        engine.submit(run_task(func.__name__, update, user_data, func(bot, update, user_data)))
 
         return ConversationHandler.END
 
-    if face_info:
-        face_rectangles = []
+    return wrapper
 
-        for face_rectangle in face_info:
-            face_rectangles.append(",".join(map(str, face_rectangle)))
 
-        params = {"faceRectangles": ";".join(face_rectangles)}
+# Runs the task as a traced update and records its latency. A task that fails is reported to the user, and an image
+# task then waits for the next task, unless the image itself cannot be read.
+async def run_task(name, update, user_data, coro, image=False):
+    with tracer.trace(name, chat_id=update.message.chat_id, msg_id=update.message.message_id,
+                      file_msg_id=user_data.get("msg_id")), handler_latency.time(name):
+        try:
+            await coro
+        except Exception as e:
+            handler_errors.inc(name)
+            logger.exception("Failed to run %s: %s" % (name, e))
 
-    headers = {"Ocp-Apim-Subscription-Key": emotion_token, "Content-Type": "application/octet-stream"}
-    result, emotion_err_msg = process_request("post", emotion_url, json, data, headers, params)
+            try:
+                if image and not is_image_error(e):
+                    await engine.call(ask_image_task, update, "Something went wrong. Please try again.")
+                elif image:
+                    clear_image(user_data)
+                    await reply_text(update, "I could not read the image you sent me. Please send me another one.",
+                                     reply_markup=ReplyKeyboardRemove())
+                else:
+                    await reply_text(update, "Something went wrong. Please try again.",
+                                     reply_markup=ReplyKeyboardRemove())
+            except Exception as e:
+                logger.error("Failed to report the error of %s: %s" % (name, e))
+
+
+# Runs the image task on the images of the album a few at a time, and replies with the results of all of them
+async def run_album_task(func, bot, update, user_data):
+    items = user_data["album"] = albums.release(update.message.chat_id, user_data["album"])
+    await reply_text(update, "Working on the %d images you sent me." % len(items), reply_markup=ReplyKeyboardRemove())
+
+    async def run_item(item):
+        message = AlbumMessage(update.message)
+
+        if item.get("too_large"):
+            message.texts.append("The image is too large for me to process. Sorry.")
+        else:
+            async with engine.semaphore("album"):
+                try:
+                    await func(bot, AlbumUpdate(message), item)
+                except Exception as e:
+                    logger.exception("Failed to run %s on image %s: %s" % (func.__name__, item["msg_id"], e))
+                    message.texts.append("Something went wrong. Please try again.")
 
-    if result:
-        process_image_face(image_name, out_image_name, result, face_info, accent_colour)
+        return message
 
-        update.message.reply_document(open(out_image_name, "rb"), caption="Here are the faces analysis on the image.")
+    messages = await asyncio.gather(*[run_item(x) for x in items])
 
-        if comp_vision_err_msg and not emotion_err_msg:
-            update.message.reply_text("I could only look at the emotions on the image but not the age and gender as I "
-                                      "probably ran out of quota of processing that information.")
-    elif emotion_err_msg:
-        update.message.reply_text(emotion_err_msg)
-    else:
-        update.message.reply_text("I could not find any faces on the image.")
+    # Replies with the text results in as few messages as possible
+    texts = ["Image %d:\n%s" % (i, "\n\n".join(x.texts)) for i, x in enumerate(messages, 1) if x.texts]
+    reply = ""
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
-    if os.path.exists(out_image_name):
-        os.remove(out_image_name)
+    for text in texts:
+        if reply and len(reply) + len(text) + 2 > MAX_MESSAGE_LENGTH:
+            await reply_text(update, reply, reply_to_message_id=user_data["msg_id"])
+            reply = ""
 
-    return ConversationHandler.END
+        reply = reply + "\n\n" + text if reply else text[:MAX_MESSAGE_LENGTH]
 
+    if reply:
+        await reply_text(update, reply, reply_to_message_id=user_data["msg_id"])
 
-# Annotates the faces on the image
-def process_image_face(image_name, out_image_name, result, face_info, accent_colour):
-    im = Image.open(image_name).convert("RGB")
-    draw = ImageDraw.Draw(im, "RGBA")
-    font = ImageFont.truetype("segoeuil.ttf", 16)
-
-    for face in result:
-        face_rectangle = face["faceRectangle"]
-        left = face_rectangle["left"]
-        top = face_rectangle["top"]
-        width = face_rectangle["width"]
-        height = face_rectangle["height"]
-        right = left + width
-        bottom = top + height
-        top_offset = top - 50 if top - 50 >= 0 else 0
-        text = ""
-
-        if (left, top, width, height) in face_info:
-            age, gender = face_info[(left, top, width, height)]
-            text += "%s %d\n" % (gender, age)
-
-        text += max(face["scores"].items(), key=operator.itemgetter(1))[0].capitalize()
-        text_size = draw.multiline_textsize(text, font)
-
-        draw.rectangle([left, top, right, bottom])
-        draw.rectangle([left, top_offset, left + text_size[0], top_offset + text_size[1]],
-                       fill=(241, 241, 242, 170))
-
-        if accent_colour:
-            draw.multiline_text((left, top_offset), text, accent_colour, font)
-        else:
-            draw.multiline_text((left, top_offset), text, (25, 149, 173), font)
+    for i, message in enumerate(messages, 1):
+        for image, caption in message.images:
+            await reply_image(update, image, "Image %d: %s" % (i, caption) if caption else "Image %d" % i)
 
-    im.save(out_image_name, "JPEG")
+    await engine.call(ask_image_task, update, "Is there anything else you want me to look for on the images?")
 
 
-# Gets categories of the image
-def get_image_category(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+# Replies to the message from the engine
+async def reply_text(update, text, **kwargs):
+    with stage("reply"):
+        return await engine.call(update.message.reply_text, text, **kwargs)
 
-    update.message.reply_text("Looking for the categories on the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
-    msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_category"
+# Replies the annotated image to the message from the engine, as a photo or a document
+async def reply_image(update, image, caption):
+    with stage("reply_image"):
+        if face_image_as_photo:
+            return await engine.call(update.message.reply_photo, image, caption=caption)
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "Categories"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+        return await engine.call(update.message.reply_document, image, filename="faces.jpg", caption=caption)
 
-    if result:
-        num_categories = len(result["categories"])
 
-        if num_categories == 1:
-            text = "I think it belongs to the category of "
-        else:
-            text = "I think it belongs to the categories of "
+# Checks if the image of the conversation is still available
+def has_image(update, user_data):
+    if user_data.get("image_id") or user_data.get("image_url"):
+        return True
 
-        for i, category in enumerate(result["categories"]):
-            name = category["name"].rstrip("_")
-            name = re.sub("_", " ", name)
+    update.message.reply_text("I no longer have the image you sent me. Please send it to me again.",
+                              reply_markup=ReplyKeyboardRemove())
 
-            if i == (num_categories - 2):
-                text += name + " and "
-            elif i == (num_categories - 1):
-                text += name
-            else:
-                text += name + ", "
+    return False
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+# Removes the image and its analysis from the conversation
+def clear_image(user_data):
+    for key in ("image_id", "image_url", "image_source", "image_data", "image_result", "album"):
+        user_data.pop(key, None)
 
-    return ConversationHandler.END
 
+# Removes the image of the conversation once its session has expired
+def expire_image(bot, job):
+    user_data, msg_id = job.context
 
-# Gets colour info of the image
-def get_image_colour(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+    # Leaves the image alone if the user has sent another file since
+    if user_data.get("msg_id") == msg_id:
+        clear_image(user_data)
 
-    update.message.reply_text("Analysing the colours on the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
+# Fully analysis an image
+@image_task
+async def get_image_full_analysis(bot, update, user_data):
+    await reply_text(update, "Analysing the image.", reply_markup=ReplyKeyboardRemove())
+
     msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_colour"
+    accent_colour = None
+    faces = []
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "Color"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+    data = await convert_and_read_image(bot, update, user_data)
+
+    # Looks for the emotions alongside the other analysis instead of waiting for it
+    emotion_request = asyncio.ensure_future(analyse_emotion(data))
+    result, comp_vision_err_msg = await analyse_image(user_data, data)
 
     if result:
-        colour = result["color"]
-        foreground_colour = colour["dominantColorForeground"]
-        background_colour = colour["dominantColorBackground"].lower()
-        accent_colour = colour["accentColor"]
-        is_bw = colour["isBWImg"]
-        dominant_colours = ", ".join(map(str.lower, colour["dominantColors"]))
-
-        if is_bw:
-            text = "This is a black and white image.\n\n"
-        else:
-            text = "This is not a black and white image.\n\n"
+        await reply_text(update, format_summary(result), reply_to_message_id=msg_id)
+        accent_colour = "#" + result.colour.accent
+        faces = result.faces
+    elif not comp_vision_err_msg:
+        emotion_request.cancel()
+        await reply_text(update, "Something went wrong. Please try again.")
+        await engine.call(ask_image_task, update)
 
-        text += "%s and %s dominate the foreground and background respectively. " % \
-                (foreground_colour, background_colour)
-        text += "The dominant colours include %s.\n\n" % dominant_colours
-        text += "And the accent colour is #%s." % accent_colour
+        return
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
+    result, emotion_err_msg = await emotion_request
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+    if result:
+        face_info = merge_faces(faces, result)
+        with stage("render", num_faces=len(result)):
+            out_image = await engine.call(process_image_face, data, result, face_info, accent_colour)
 
-    return ConversationHandler.END
+        await reply_image(update, out_image, "Here are the faces analysis on the image.")
 
+        if comp_vision_err_msg and not emotion_err_msg:
+            await reply_text(update, "I could only look at the emotions on the image but not the age and gender as I "
+                                     "probably ran out of quota of processing that information.")
+    elif emotion_err_msg:
+        await reply_text(update, emotion_err_msg)
+    else:
+        await reply_text(update, "I could not find any faces on the image.")
 
-# Gets a description of the image
-def get_image_description(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+    await engine.call(ask_image_task, update)
 
-    update.message.reply_text("Trying to describe the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
-    msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_description"
+# Looks for the faces and their emotions on the image
+async def analyse_emotion(data):
+    if not data:
+        return None, None
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
+    headers = {"Content-Type": "application/octet-stream"}
     json = None
-    params = {"visualFeatures": "Description", "details": "Landmarks"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+    params = None
 
-    if result:
-        target_landmark = None
-        target_caption = None
-        max_landmark_conf = 0
-        max_caption_conf = 0
-
-        if "categories" in result:
-            for category in result["categories"]:
-                if "detail" in category and "landmarks" in category["detail"]:
-                    for landmark in category["detail"]["landmarks"]:
-                        landmark_name, landmark_conf = landmark["name"], landmark["confidence"]
-
-                        if landmark_conf > max_landmark_conf:
-                            target_landmark = landmark_name
-                            max_landmark_conf = landmark_conf
-
-        if target_landmark:
-            text = "I'll say it's the %s." % target_landmark
-        else:
-            for caption in result["description"]["captions"]:
-                caption_text, caption_conf = caption["text"], caption["confidence"]
+    return await process_request("post", emotion_url, json, data, headers, params)
 
-                if caption_conf > max_caption_conf:
-                    target_caption = caption_text
-                    max_caption_conf = caption_conf
 
-            text = "I'll say it's %s." % target_caption
+# Matches the age and gender of the faces to the faces found by the Emotion API by how much they overlap
+def merge_faces(faces, emotion_faces):
+    face_info = {}
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
+    for emotion_face in emotion_faces:
+        face_rectangle = get_face_rectangle(emotion_face)
+        max_overlap = face_overlap_threshold
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+        for face in faces:
+            overlap = get_face_overlap(face_rectangle, face.rectangle)
 
-    return ConversationHandler.END
+            if overlap >= max_overlap:
+                face_info[face_rectangle] = (face.age, face.gender)
+                max_overlap = overlap
 
+    return face_info
 
-# Gets faces (age, emotion, gender) on the image, and adds annotation onto the image
-def get_image_face(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
 
-    update.message.reply_text("Analysing the faces on the image.", reply_markup=ReplyKeyboardRemove())
+# Returns the (left, top, width, height) of the face
+def get_face_rectangle(face):
+    face_rectangle = face["faceRectangle"]
 
-    tele_id = update.message.from_user.id
-    image_name = str(tele_id) + "_face"
-    out_image_name = image_name + "_done"
-    accent_colour = None
-    face_info = {}
+    return face_rectangle["left"], face_rectangle["top"], face_rectangle["width"], face_rectangle["height"]
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "Faces, Color"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, face_err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
 
-    if result:
-        accent_colour = "#" + result["color"]["accentColor"]
+# Returns the intersection over union of two face rectangles
+def get_face_overlap(rect_a, rect_b):
+    left = max(rect_a[0], rect_b[0])
+    top = max(rect_a[1], rect_b[1])
+    right = min(rect_a[0] + rect_a[2], rect_b[0] + rect_b[2])
+    bottom = min(rect_a[1] + rect_a[3], rect_b[1] + rect_b[3])
 
-        for face in result["faces"]:
-            age, gender = face["age"], face["gender"]
-            face_rectangle = face["faceRectangle"]
-            left = face_rectangle["left"]
-            top = face_rectangle["top"]
-            width = face_rectangle["width"]
-            height = face_rectangle["height"]
+    if right <= left or bottom <= top:
+        return 0
 
-            face_info[(left, top, width, height)] = (age, gender)
-    elif not face_err_msg:
-        update.message.reply_text("I could not find any faces on the image.")
+    intersection = (right - left) * (bottom - top)
+    union = rect_a[2] * rect_a[3] + rect_b[2] * rect_b[3] - intersection
 
-        if os.path.exists(image_name):
-            os.remove(image_name)
-        if os.path.exists(out_image_name):
-            os.remove(out_image_name)
+    return intersection / union
 
-        return ConversationHandler.END
 
-    if face_info:
-        face_rectangles = []
+# Annotates the faces on the image and returns the annotated image in a JPEG buffer
+def process_image_face(data, result, face_info, accent_colour):
+    return face_renderer.render(data, result, face_info, accent_colour)
 
-        for face_rectangle in face_info:
-            face_rectangles.append(",".join(map(str, face_rectangle)))
 
-        params = {"faceRectangles": ";".join(face_rectangles)}
+# Gets categories of the image
+@image_task
+async def get_image_category(bot, update, user_data):
+    await reply_text(update, "Looking for the categories on the image.", reply_markup=ReplyKeyboardRemove())
 
-    headers = {"Ocp-Apim-Subscription-Key": emotion_token, "Content-Type": "application/octet-stream"}
-    result, emotion_err_msg = process_request("post", emotion_url, json, data, headers, params)
+    msg_id = user_data["msg_id"]
+
+    data = await convert_and_read_image(bot, update, user_data)
+    result, err_msg = await analyse_image(user_data, data)
 
     if result:
-        process_image_face(image_name, out_image_name, result, face_info, accent_colour)
+        await reply_text(update, format_categories(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
 
-        update.message.reply_document(open(out_image_name, "rb"), caption="Here are the faces on the image.")
-    elif face_err_msg and not emotion_err_msg:
-        update.message.reply_text("I could only look at the emotions on the image but not the age and gender as I "
-                                  "probably ran out of quota of processing that information.")
-    elif emotion_err_msg:
-        update.message.reply_text(emotion_err_msg)
-    else:
-        update.message.reply_text("I could not find any faces on the image.")
+    await engine.call(ask_image_task, update)
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
-    if os.path.exists(out_image_name):
-        os.remove(out_image_name)
 
-    return ConversationHandler.END
+# Gets colour info of the image
+@image_task
+async def get_image_colour(bot, update, user_data):
+    await reply_text(update, "Analysing the colours on the image.", reply_markup=ReplyKeyboardRemove())
 
+    msg_id = user_data["msg_id"]
 
-# Gets tags of the image
-def get_image_tag(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+    data = await convert_and_read_image(bot, update, user_data)
+    result, err_msg = await analyse_image(user_data, data)
 
-    update.message.reply_text("Looking for tags of the image.", reply_markup=ReplyKeyboardRemove())
+    if result:
+        await reply_text(update, format_colour(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
+
+    await engine.call(ask_image_task, update)
+
+
+# Gets a description of the image
+@image_task
+async def get_image_description(bot, update, user_data):
+    await reply_text(update, "Trying to describe the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
     msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_tag"
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "Tags"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+    data = await convert_and_read_image(bot, update, user_data)
+    result, err_msg = await analyse_image(user_data, data)
 
     if result:
-        num_tags = len(result["tags"])
+        await reply_text(update, format_description(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
 
-        if num_tags == 0:
-            text = "I can't find any tags for it."
-        elif num_tags == 1:
-            text = "I think it is "
-        else:
-            text = "I think it has tags of "
+    await engine.call(ask_image_task, update)
 
-        for i, category in enumerate(result["tags"]):
-            tag_name = "#" + category["name"].rstrip("_")
-            tag_name = re.sub(" ", "", tag_name)
 
-            if i == (num_tags - 2):
-                text += tag_name + " and "
-            elif i == (num_tags - 1):
-                text += tag_name
-            else:
-                text += tag_name + ", "
+# Gets faces (age, emotion, gender) on the image, and adds annotation onto the image
+@image_task
+async def get_image_face(bot, update, user_data):
+    await reply_text(update, "Analysing the faces on the image.", reply_markup=ReplyKeyboardRemove())
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
+    accent_colour = None
+    faces = []
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+    data = await convert_and_read_image(bot, update, user_data)
 
-    return ConversationHandler.END
+    # Looks for the age, gender and emotions of the faces at the same time
+    (result, face_err_msg), (emotion_result, emotion_err_msg) = \
+        await asyncio.gather(analyse_image(user_data, data), analyse_emotion(data))
 
+    if result:
+        accent_colour = "#" + result.colour.accent
+        faces = result.faces
+    elif not face_err_msg:
+        await reply_text(update, "I could not find any faces on the image.")
+        await engine.call(ask_image_task, update)
 
-# Gets normal text from the image
-def get_image_normal_text(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
         return
 
-    update.message.reply_text("Looking for normal text on the image.", reply_markup=ReplyKeyboardRemove())
+    result = emotion_result
+
+    if result:
+        face_info = merge_faces(faces, result)
+        with stage("render", num_faces=len(result)):
+            out_image = await engine.call(process_image_face, data, result, face_info, accent_colour)
+
+        await reply_image(update, out_image, "Here are the faces on the image.")
+    elif face_err_msg and not emotion_err_msg:
+        await reply_text(update, "I could only look at the emotions on the image but not the age and gender as I "
+                                 "probably ran out of quota of processing that information.")
+    elif emotion_err_msg:
+        await reply_text(update, emotion_err_msg)
+    else:
+        await reply_text(update, "I could not find any faces on the image.")
+
+    await engine.call(ask_image_task, update)
+
+
+# Gets tags of the image
+@image_task
+async def get_image_tag(bot, update, user_data):
+    await reply_text(update, "Looking for tags of the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
     msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_tag"
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"handwriting": False}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_text_url, json, data, headers, params)
+    data = await convert_and_read_image(bot, update, user_data)
+    result, err_msg = await analyse_image(user_data, data)
 
     if result:
-        text = ""
+        await reply_text(update, format_tags(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
 
-        for region in result["regions"]:
-            for line in region["lines"]:
-                for word in line["words"]:
-                    text += word["text"] + " "
+    await engine.call(ask_image_task, update)
 
-                text += "\n"
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
+# Gets normal text from the image
+@image_task
+async def get_image_normal_text(bot, update, user_data):
+    await reply_text(update, "Looking for normal text on the image.", reply_markup=ReplyKeyboardRemove())
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+    msg_id = user_data["msg_id"]
 
-    return ConversationHandler.END
+    headers = {"Content-Type": "application/octet-stream"}
+    json = None
+    params = {"handwriting": False}
+    data = await convert_and_read_image(bot, update, user_data, "text")
+    result, err_msg = await process_request("post", comp_vision_text_url, json, data, headers, params,
+                                            TextResult.from_ocr)
 
+    if result:
+        await reply_text(update, format_text(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
 
-# Gets handwritten text from the image
-def get_image_handwritten_text(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
+    await engine.call(ask_image_task, update)
 
-    update.message.reply_text("Looking for handwritten text on the image.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
+# Gets handwritten text from the image
+@image_task
+async def get_image_handwritten_text(bot, update, user_data):
+    await reply_text(update, "Looking for handwritten text on the image.", reply_markup=ReplyKeyboardRemove())
+
     msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_tag"
     operation_url = None
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
+    headers = {"Content-Type": "application/octet-stream"}
     json = None
     params = {"handwriting": True}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-
-    response = requests.request(method="post", url=comp_vision_text_url, json=json, data=data, headers=headers,
-                                params=params)
+    data = await convert_and_read_image(bot, update, user_data, "text")
 
-    if response.status_code == 403:
-        update.message.reply_text("I ran out of quota for processing images. Please try again later. Sorry.")
+    # Users that send the same image at the same time wait for the same operation
+    response = await flights.do(make_key(comp_vision_text_url, data, params), send_request, "vision", "post",
+                                comp_vision_text_url, json=json, data=data, headers=headers, params=params)
 
-        if os.path.exists(image_name):
-            os.remove(image_name)
+    if response is None or response.status_code in (403, 429):
+        await reply_text(update, "I ran out of quota for processing images. Please try again later. Sorry.")
+        await engine.call(ask_image_task, update)
 
-        return ConversationHandler.END
+        return
     elif response.status_code == 202:
         operation_url = response.headers["Operation-Location"]
 
     if operation_url:
-        headers = {"Ocp-Apim-Subscription-Key": comp_vision_token}
-        json = None
-        params = None
-        data = None
-        result, err_msg = process_request("get", operation_url, json, data, headers, params)
+        # The operation can only be read with the key that submitted it
+        token = response.request.headers["Ocp-Apim-Subscription-Key"]
+        headers = {"Ocp-Apim-Subscription-Key": token}
+        key = key_pools["vision"].find(token)
 
-        if result:
-            text = ""
-            recognition_result = result["recognitionResult"]
-
-            for line in recognition_result["lines"]:
-                text += line["text"] + "\n"
+        # Waits for the poller to deliver the result without holding up a thread
+        try:
+            with stage("vision_operation"):
+                result, err_msg = parse_response(await poller.wait(operation_url, headers, key))
+        except asyncio.TimeoutError:
+            result, err_msg = None, "It took too long to look for handwritten text on the image. Please try again."
 
-            update.message.reply_text(text, reply_to_message_id=msg_id)
+        if result:
+            await reply_text(update, format_text(TextResult.from_handwritten(result)), reply_to_message_id=msg_id)
         elif err_msg:
-            update.message.reply_text(err_msg)
-
-    if os.path.exists(image_name):
-        os.remove(image_name)
+            await reply_text(update, err_msg)
 
-    return ConversationHandler.END
+    await engine.call(ask_image_task, update)
 
 
 # Gets image type
-def get_image_type(bot, update, user_data):
-    if ("image_id" in user_data and not user_data["image_id"]) or \
-            ("image_url" in user_data and not user_data["image_url"]):
-        return
-
-    update.message.reply_text("Identifying the image type.", reply_markup=ReplyKeyboardRemove())
+@image_task
+async def get_image_type(bot, update, user_data):
+    await reply_text(update, "Identifying the image type.", reply_markup=ReplyKeyboardRemove())
 
-    tele_id = update.message.from_user.id
     msg_id = user_data["msg_id"]
-    image_name = str(tele_id) + "_type"
 
-    headers = {"Ocp-Apim-Subscription-Key": comp_vision_token, "Content-Type": "application/octet-stream"}
-    json = None
-    params = {"visualFeatures": "ImageType"}
-    data = convert_and_read_image(bot, update, user_data, image_name)
-    result, err_msg = process_request("post", comp_vision_analysis_url, json, data, headers, params)
+    data = await convert_and_read_image(bot, update, user_data)
+    result, err_msg = await analyse_image(user_data, data)
 
     if result:
-        image_type = result["imageType"]
-        clip_art_type, line_drawing_type = image_type["clipArtType"], image_type["lineDrawingType"]
-        clip_art_type = clip_art_types[clip_art_type]
+        await reply_text(update, format_image_type(result), reply_to_message_id=msg_id)
+    elif err_msg:
+        await reply_text(update, err_msg)
 
-        if clip_art_type == "ambiguous":
-            text = "I'm not sure if it's a clip art or not, but "
-        else:
-            text = "I think it's a %s, and " % clip_art_type
+    await engine.call(ask_image_task, update)
 
-        if line_drawing_type:
-            text += "I think it's a line drawing."
-        else:
-            text += "I think it's not a line drawing."
 
-        update.message.reply_text(text, reply_to_message_id=msg_id)
-    elif err_msg:
-        update.message.reply_text(err_msg)
+# Analyses the image with all the visual features once and reuses the result for the other tasks
+async def analyse_image(user_data, data):
+    if "image_result" in user_data:
+        cache_requests.inc("session", "hit")
 
-    if os.path.exists(image_name):
-        os.remove(image_name)
+        return user_data["image_result"], None
+    elif not data:
+        return None, None
 
-    return ConversationHandler.END
+    headers = {"Content-Type": "application/octet-stream"}
+    json = None
+    params = {"visualFeatures": image_features, "details": image_details}
+    result, err_msg = await process_request("post", comp_vision_analysis_url, json, data, headers, params,
+                                            ImageAnalysis.from_json)
 
+    if result:
+        user_data["image_result"] = result
 
-# Checks if the image format is supported, if not converts it into JPEG format
-def convert_and_read_image(bot, update, user_data, image_name):
-    if "image_id" in user_data and user_data["image_id"]:
-        image_id = user_data["image_id"]
-        del user_data["image_id"]
-        image_file = bot.get_file(image_id)
-        image_file.download(image_name)
-    else:
-        image_url = user_data["image_url"]
-        del user_data["image_url"]
-        response = requests.get(image_url)
-
-        if response.status_code == 200:
-            with open(image_name, "wb") as f:
-                for chunk in response:
-                    f.write(chunk)
+    return result, err_msg
+
+
+# Reads the image and prepares it for the task, downscaling and converting it into JPEG format if needed
+async def convert_and_read_image(bot, update, user_data, profile="analysis"):
+    images = user_data.setdefault("image_data", {})
+
+    # Reuses the image prepared for a previous task
+    if profile in images:
+        return images[profile]
+
+    if "image_source" not in user_data:
+        if user_data.get("image_id"):
+            user_data["image_source"] = await download_file(bot, user_data["image_id"], user_data.get("file_key"))
         else:
-            update.message.reply_text("I could not download the image from the URL you sent me. Please check the URL "
-                                      "and try again.")
+            # The image of a URL is not saved with the user data, so it is fetched again after a restart
+            status, _, data = await engine.call(fetch_url, ingest_http, user_data["image_url"],
+                                                {"image": image_size_limit})
+
+            if status != FETCH_OK:
+                return None
 
-    im = Image.open(image_name)
-    if im.format not in ("JPEG", "PNG", "GIF", "BMP"):
-        im.save(image_name, "JPEG")
+            user_data["image_source"] = data
 
-    with open(image_name, "rb") as f:
-        data = f.read()
+    with stage("prepare", profile=profile, size=len(user_data["image_source"])):
+        data = await engine.call(prepare_image, user_data["image_source"], image_profiles[profile], image_quality,
+                                 cognitive_image_size_limit)
+    images[profile] = data
 
     return data
 
 
 # Returns the text of an audio
-def audio_to_text(bot, update, user_data):
-    if ("audio_id" in user_data and not user_data["audio_id"]) or \
-            ("audio_url" in user_data and not user_data["audio_url"]):
+@audio_task
+async def audio_to_text(bot, update, user_data):
+    await reply_text(update, "Analysing your audio.", reply_markup=ReplyKeyboardRemove())
+
+    msg_id = user_data["msg_id"]
+    pcm = await convert_and_read_audio(bot, update, user_data)
+
+    if pcm is None:
         return
 
-    update.message.reply_text("Analysing your audio.", reply_markup=ReplyKeyboardRemove())
+    # Recognises all the segments at the same time
+    segments = split_segments(pcm, audio_segment_min_length, audio_segment_max_length)
+    requests = [asyncio.ensure_future(recognise_audio(segment)) for segment in segments]
+    message = None
+    text = ""
+    err_msg = None
+    gap = False
 
-    tele_id = update.message.from_user.id
-    msg_id = user_data["msg_id"]
-    audio_name = str(tele_id) + "_audio.wav"
-    audio_temp_name = audio_name + "_temp"
+    # Adds the text to the reply, or starts a new reply if it does not fit
+    async def add_text(segment_text):
+        nonlocal message, text
+
+        if message is None or len(text) + len(segment_text) >= MAX_MESSAGE_LENGTH:
+            text = segment_text
+            message = await reply_text(update, text, reply_to_message_id=msg_id)
+        else:
+            text += " " + segment_text
+            await engine.call(message.edit_text, text)
+
+    # Adds the text of each segment to the reply in order, as soon as it is ready, marking the segments that failed
+    for request in requests:
+        segment_text, segment_err_msg = await request
+
+        if segment_err_msg:
+            err_msg = segment_err_msg
+            gap = True
+        elif segment_text:
+            await add_text("%s %s" % (audio_gap_marker, segment_text) if gap else segment_text)
+            gap = False
+
+    if message is None:
+        await reply_text(update, err_msg if err_msg else "I could not understand the audio. Sorry",
+                         reply_to_message_id=msg_id)
+    elif err_msg:
+        if gap:
+            await add_text(audio_gap_marker)
 
-    audio = convert_and_read_audio(bot, update, user_data, audio_name, audio_temp_name)
-    r = sr.Recognizer()
+        await reply_text(update, err_msg, reply_to_message_id=msg_id)
 
-    try:
-        text = r.recognize_bing(audio, key=bing_speech_token) + "\n"
-    except sr.UnknownValueError:
-        text = "I could not understand the audio. Sorry"
-    except sr.RequestError as e:
-        logger.error("Could not request results from Microsoft Bing Voice Recognition service; {0}".format(e))
-        text = "Something went wrong. Please try again."
 
-    update.message.reply_text(text, reply_to_message_id=msg_id)
+# Recognises the speech of the audio segment and returns the text and error message
+async def recognise_audio(pcm):
+    audio = sr.AudioData(pcm, pcm_sample_rate, pcm_sample_width)
+    pool = key_pools["speech"]
 
-    if os.path.exists(audio_name):
-        os.remove(audio_name)
-    if os.path.exists(audio_temp_name):
-        os.remove(audio_temp_name)
+    # Moves on to the next key if the key has run out of quota
+    while True:
+        key = await pool.acquire()
 
-    return ConversationHandler.END
+        if key is None:
+            return None, "I ran out of quota for processing audios. Please try again later. Sorry."
 
+        try:
+            async with engine.semaphore("speech"):
+                with in_flight_requests.track("speech"), stage("speech", size=len(pcm)):
+                    text = await engine.call(get_recognizer(key).recognize_bing, audio, key=key.token)
 
-# Converts the audio to wav format and reads it
-def convert_and_read_audio(bot, update, user_data, audio_name, audio_temp_name):
+            upstream_responses.inc("speech", "200")
+            pool.report(key, 200)
+
+            return text, None
+        except sr.UnknownValueError:
+            upstream_responses.inc("speech", "200")
+            pool.report(key, 200)
+
+            return None, None
+        except sr.RequestError as e:
+            status_code = speech_error_codes.get(str(e).rpartition(": ")[2])
+
+            if status_code:
+                upstream_responses.inc("speech", str(status_code))
+                pool.report(key, status_code)
+
+                continue
+
+            logger.error("Could not request results from Microsoft Bing Voice Recognition service; {0}".format(e))
+
+            return None, "Something went wrong. Please try again."
+
+
+# Returns the recognizer of the key. The recognizer keeps the access token of its key for 10 minutes, so each key has
+# its own one instead of fetching a token for every segment.
+def get_recognizer(key):
+    recognizer = speech_recognizers.get(key.token)
+
+    if recognizer is None:
+        recognizer = speech_recognizers[key.token] = sr.Recognizer()
+
+    return recognizer
+
+
+# Converts the audio into 16 kHz mono PCM and reads it
+async def convert_and_read_audio(bot, update, user_data):
     if "audio_id" in user_data and user_data["audio_id"]:
         audio_id = user_data["audio_id"]
         del user_data["audio_id"]
-        audio_file = bot.get_file(audio_id)
-        audio_file.download(audio_temp_name)
+        data = await download_file(bot, audio_id, user_data.get("file_key"))
     else:
-        audio_url = user_data["audio_url"]
-        del user_data["audio_url"]
-        response = requests.get(audio_url)
-
-        if response.status_code == 200:
-            with open(audio_temp_name, "wb") as f:
-                for chunk in response:
-                    f.write(chunk)
-        else:
-            update.message.reply_text("I could not download the audio from the URL you sent me. Please check the URL "
-                                      "and try again.")
+        audio_url = user_data.pop("audio_url")
+        data = user_data.pop("audio_data", None)
 
-    command = "ffmpeg -y -i {input_audio} {output_audio}". \
-        format(input_audio=audio_temp_name, output_audio=audio_name)
+        # The audio of a URL is not saved with the user data, so it is fetched again after a restart
+        if data is None:
+            status, _, data = await engine.call(fetch_url, ingest_http, audio_url,
+                                                {"audio": cognitive_audio_size_limit})
 
-    process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
-    process_out, process_err = process.communicate()
+            if status != FETCH_OK:
+                await reply_text(update, "I could not retrieve the file from the URL you sent me. Please try again.")
 
-    if process.returncode != 0 or not os.path.exists(audio_name) or "[Errno" in process_err.decode("utf8").strip():
-        update.message.reply_text("Something went wrong")
+                return None
 
-        return ConversationHandler.END
+    with stage("transcode", size=len(data)):
+        pcm = await transcode(engine, data)
 
-    r = sr.Recognizer()
-    with sr.AudioFile(audio_name) as source:
-        audio = r.record(source)
+    if pcm is None:
+        await reply_text(update, "Something went wrong")
 
-    return audio
+        return None
 
+    return pcm
 
-# Processes request
-def process_request(method, url, json, data, headers, params):
-    result = None
-    err_msg = None
+
+# Returns the Telegram file from the cache or downloads it, sharing the download with the other users that sent the
+# same file at the same time
+async def download_file(bot, file_id, file_key=None):
+    file_key = file_key if file_key else file_id
+    data = await engine.call(file_cache.get, file_key)
+    cache_requests.inc("file", "miss" if data is None else "hit")
+
+    if data is None:
+        data = await flights.do(("download", file_key), _download_file, bot, file_id, file_key)
+
+    return data
+
+
+async def _download_file(bot, file_id, file_key):
+    file_buf = io.BytesIO()
+
+    async with engine.semaphore("download"):
+        with stage("download"):
+            telegram_file = await engine.call(bot.get_file, file_id)
+            await engine.call(telegram_file.download, out=file_buf)
+            tracer.annotate(size=file_buf.tell())
+
+    data = file_buf.getvalue()
+    await engine.call(file_cache.set, file_key, data)
+
+    return data
+
+
+# Sends the request and returns the result, decoded if a decoder is given, or the error message
+async def process_request(method, url, json, data, headers, params, decode=None):
+    if method != "post" or not data:
+        return await _process_request(method, url, json, data, headers, params, decode)
+
+    key = make_key(url, data, params)
+    cache_key = None
+
+    # Skips the request if the same image has been analysed with the same params
+    if url in (comp_vision_analysis_url, emotion_url):
+        cache_key = key
+        result = await engine.call(result_cache.get, cache_key)
+        cache_requests.inc("result", "miss" if result is None else "hit")
+
+        if result is not None:
+            return decode(result) if decode else result, None
+
+    # Waits for the same request that is already in flight instead of sending it again, sharing its decoded result
+    return await flights.do(key, _process_request, method, url, json, data, headers, params, decode, cache_key)
+
+
+async def _process_request(method, url, json, data, headers, params, decode=None, cache_key=None):
+    service = "emotion" if url == emotion_url else "vision"
+    response = await send_request(service, method, url, json=json, data=data, headers=headers, params=params)
+
+    if response is None:
+        return None, "I ran out of quota for processing images. Please try again later. Sorry."
+
+    result, err_msg = parse_response(response)
+
+    if result is None:
+        return None, err_msg
+
+    # The cache keeps the JSON so that it can be written to disk
+    if cache_key:
+        await engine.call(result_cache.set, cache_key, result)
+
+    return decode(result) if decode else result, err_msg
+
+
+# Sends the request with one of the subscription keys of the service.
+# Returns the last response if all the keys have run out of quota, or None if they were all resting already.
+async def send_request(service, method, url, headers, **kwargs):
+    pool = key_pools[service]
+    response = None
 
     while True:
-        response = requests.request(method=method, url=url, json=json, data=data, headers=headers, params=params)
+        key = await pool.acquire()
 
-        if response.status_code == 403:
-            err_msg = "I ran out of quota for processing images. Please try again later. Sorry."
-        elif response.status_code == 200:
-            if int(response.headers["content-length"]) != 0 and \
-                            "application/json" in response.headers["content-type"].lower():
-                if "status" in response.json():
-                    if response.json()["status"] in ("Not started", "Running"):
-                        time.sleep(3)
+        if key is None:
+            return response
 
-                        continue
-                    elif response.json()["status"] == "Failed":
-                        err_msg = "Something went wrong. Please try again."
+        key_headers = dict(headers, **{"Ocp-Apim-Subscription-Key": key.token})
 
-                        break
+        with in_flight_requests.track(service), stage(service, size=len(kwargs.get("data") or b""),
+                                                      params=kwargs.get("params")):
+            response = await engine.request(service, method, url, headers=key_headers, **kwargs)
 
-                result = response.json() if response.content else None
-        else:
-            err_msg = "Something went wrong. Please try again."
+        upstream_responses.inc(service, str(response.status_code))
+        pool.report(key, response.status_code, response.headers.get("Retry-After"))
 
-            try:
-                logger.error("Error code: %d, Message: %s" % (response.status_code, response.json()["message"]))
-            except KeyError:
-                pass
+        if response.status_code not in (403, 429):
+            return response
 
-            try:
-                logger.error("Error code: %d, Message: %s" %
-                             (response.status_code, response.json()["error"]["message"]))
-            except KeyError:
-                pass
 
-        break
+# Reads the result or error message from the response
+def parse_response(response):
+    result = None
+    err_msg = None
+
+    if response.status_code in (403, 429):
+        err_msg = "I ran out of quota for processing images. Please try again later. Sorry."
+    elif response.status_code == 200:
+        if int(response.headers["content-length"]) != 0 and \
+                        "application/json" in response.headers["content-type"].lower():
+            body = response.json()
+
+            if isinstance(body, dict) and body.get("status") == "Failed":
+                err_msg = "Something went wrong. Please try again."
+            else:
+                result = body
+    else:
+        err_msg = "Something went wrong. Please try again."
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        if isinstance(body, dict):
+            if "message" in body:
+                logger.error("Error code: %d, Message: %s" % (response.status_code, body["message"]))
+
+            if isinstance(body.get("error"), dict) and "message" in body["error"]:
+                logger.error("Error code: %d, Message: %s" % (response.status_code, body["error"]["message"]))
 
     return result, err_msg
 
@@ -1019,6 +1372,7 @@ def feedback_cov_handler():
 
         allow_reentry=True
     )
+    conv_handler.conversations = state_store.mapping("feedback_conversations", persist=conversation_state)
 
     return conv_handler
 
@@ -1036,36 +1390,29 @@ def feedback(bot, update):
 @run_async
 def receive_feedback(bot, update):
     feedback_msg = update.message.text
-    valid_lang = False
-    langdetect.DetectorFactory.seed = 0
-    langs = langdetect.detect_langs(feedback_msg)
-
-    for lang in langs:
-        if lang.lang in ("en", "zh-tw", "zh-cn"):
-            valid_lang = True
-            break
 
-    if not valid_lang:
+    if not is_accepted_language(feedback_msg):
         update.message.reply_text("The feedback you sent is not in English or Chinese. Please try again.")
         return 0
 
     update.message.reply_text("Thank you for your feedback, I will let my developer know.")
 
     if is_email_feedback:
-        server = smtplib.SMTP(smtp_host)
-        server.ehlo()
-        server.starttls()
-        server.login(dev_email, dev_email_pw)
-
-        text = "Feedback received from %d\n\n%s" % (update.message.from_user.id, update.message.text)
-        message = "Subject: %s\n\n%s" % ("Telegram Big Two Bot Feedback", text)
-        server.sendmail(dev_email, dev_email, message)
+        mailer.send("Feedback received from %d\n\n%s" % (update.message.from_user.id, update.message.text))
     else:
         logger.info("Feedback received from %d: %s" % (update.message.from_user.id, update.message.text))
 
     return ConversationHandler.END
 
 
+# Cancels the image/audio operation
+def cancel_file(bot, update, user_data):
+    clear_image(user_data)
+    update.message.reply_text("Operation cancelled.", reply_markup=ReplyKeyboardRemove())
+
+    return ConversationHandler.END
+
+
 # Cancels feedback opteration
 @run_async
 def cancel(bot, update):
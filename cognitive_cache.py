@@ -0,0 +1,229 @@
+# coding: utf-8
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Builds a cache key from the endpoint, the image bytes and the request params
+def make_key(url, data, params):
+    items = []
+
+    if params:
+        for name in sorted(params):
+            value = params[name]
+
+            # Feature lists are order insensitive, e.g. "Tags, Color" is the same as "Color, Tags"
+            if isinstance(value, str) and "," in value:
+                value = ",".join(sorted(x.strip() for x in value.split(",")))
+
+            items.append("%s=%s" % (name, value))
+
+    key = "%s|%s|%s" % (url, hashlib.sha256(data).hexdigest(), "&".join(items))
+
+    return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+
+# Two tier (memory and optional disk) cache for API results with TTL and size based eviction
+class ResultCache(object):
+    suffix = ".json"
+    binary = False
+
+    def __init__(self, max_entries=1000, ttl=86400, cache_dir=None, max_disk_bytes=100000000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_usage = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_usage = sum(size for _, _, size in self._disk_files())
+
+    # Returns the cached result of the key, or None if it is missing or expired
+    def get(self, key):
+        now = time.time()
+
+        with self._lock:
+            if key in self._entries:
+                expires, value = self._entries[key]
+
+                if expires > now:
+                    self._entries.move_to_end(key)
+
+                    return value
+
+                self._memory_remove(key)
+
+        if not self.cache_dir:
+            return None
+
+        value, expires = self._disk_get(key, now)
+
+        # Keeps the expiry of the file, so that the entry does not live longer for being read back
+        if value is not None:
+            with self._lock:
+                self._memory_set(key, value, expires)
+
+        return value
+
+    # Stores the result of the key
+    def set(self, key, value):
+        now = time.time()
+
+        with self._lock:
+            self._memory_set(key, value, now + self.ttl)
+
+        if self.cache_dir:
+            self._disk_set(key, value)
+
+    def _memory_set(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _memory_remove(self, key):
+        del self._entries[key]
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _load(self, f):
+        return json.load(f)
+
+    def _dump(self, value, f):
+        json.dump(value, f)
+
+    # Returns the value of the file and when it expires. The modification time is when the file was written, and the
+    # access time when it was last read.
+    def _disk_get(self, key, now):
+        path = self._disk_path(key)
+
+        try:
+            written = os.path.getmtime(path)
+
+            if written + self.ttl <= now:
+                with self._lock:
+                    self._disk_remove(path)
+
+                return None, None
+
+            with open(path, "rb" if self.binary else "r") as f:
+                value = self._load(f)
+
+            # Sets the access time only, so that disk eviction is least recently used and the TTL still runs from
+            # the write
+            os.utime(path, (now, written))
+        except (OSError, ValueError):
+            return None, None
+
+        return value, written + self.ttl
+
+    def _disk_set(self, key, value):
+        path = self._disk_path(key)
+        temp_path = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+            with open(temp_path, "wb" if self.binary else "w") as f:
+                self._dump(value, f)
+
+            new_size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Failed to write cache file %s: %s" % (path, e))
+
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            return
+
+        with self._lock:
+            self._disk_usage += new_size - old_size
+
+            if self._disk_usage > self.max_disk_bytes:
+                self._disk_evict()
+
+    # Removes the least recently used files until the disk usage is below 90% of the limit
+    def _disk_evict(self):
+        target = self.max_disk_bytes * 0.9
+
+        for path, _, size in sorted(self._disk_files(), key=lambda x: x[1]):
+            if self._disk_usage <= target:
+                break
+
+            self._disk_remove(path, size)
+
+    def _disk_remove(self, path, size=None):
+        try:
+            size = os.path.getsize(path) if size is None else size
+            os.remove(path)
+            self._disk_usage -= size
+        except OSError:
+            pass
+
+    def _disk_files(self):
+        files = []
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+
+            path = os.path.join(self.cache_dir, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            files.append((path, max(stat.st_atime, stat.st_mtime), stat.st_size))
+
+        return files
+
+
+# Two tier cache for downloaded files, with the memory tier bounded by the bytes it keeps rather than the entries
+class BlobCache(ResultCache):
+    suffix = ".bin"
+    binary = True
+
+    def __init__(self, max_memory_bytes=50000000, ttl=86400, cache_dir=None, max_disk_bytes=500000000):
+        self.max_memory_bytes = max_memory_bytes
+        self._memory_usage = 0
+        super().__init__(None, ttl, cache_dir, max_disk_bytes)
+
+    def _memory_set(self, key, value, expires):
+        if key in self._entries:
+            self._memory_remove(key)
+
+        self._entries[key] = (expires, value)
+        self._memory_usage += len(value)
+
+        while self._memory_usage > self.max_memory_bytes:
+            _, (_, old_value) = self._entries.popitem(last=False)
+            self._memory_usage -= len(old_value)
+
+    def _memory_remove(self, key):
+        _, value = self._entries.pop(key)
+        self._memory_usage -= len(value)
+
+    # File ids are hashed as they are not guaranteed to be safe file names
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf8")).hexdigest() + self.suffix)
+
+    def _load(self, f):
+        return f.read()
+
+    def _dump(self, value, f):
+        f.write(value)
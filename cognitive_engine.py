@@ -0,0 +1,104 @@
+# coding: utf-8
+
+import asyncio
+import functools
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+# Runs coroutines on an event loop in a background thread, with a concurrency limit per upstream service
+class AsyncEngine(object):
+    def __init__(self, http, limits=None, workers=32):
+        self.http = http
+        self.limits = limits if limits else {}
+        self.workers = workers
+        self.loop = None
+        self._executor = None
+        self._semaphores = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.loop.set_default_executor(self._executor)
+
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name="engine", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._executor.shutdown(wait=False)
+            self.loop.close()
+            self._thread = None
+            self._semaphores = {}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    # Schedules the coroutine from any thread and returns a concurrent future of its result
+    def submit(self, coro):
+        if not self.running:
+            self.start()
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_exception)
+
+        return future
+
+    # Runs the coroutine from a thread outside of the engine and waits for its result
+    def run(self, coro, timeout=None):
+        return self.submit(coro).result(timeout)
+
+    @staticmethod
+    def _log_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            logger.error("Engine task failed: %s" % e, exc_info=(type(e), e, e.__traceback__))
+
+    # Returns the semaphore that limits the concurrent calls to the service
+    def semaphore(self, service):
+        if service not in self._semaphores:
+            self._semaphores[service] = asyncio.Semaphore(self.limits.get(service, self.workers))
+
+        return self._semaphores[service]
+
+    # Runs a blocking function in the worker threads
+    async def call(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    # Sends a request through the shared connection pool, waiting for a free slot of the service
+    async def request(self, service, method, url, **kwargs):
+        async with self.semaphore(service):
+            return await self.call(self.http.request, method, url, **kwargs)
+
+    # Runs a process and returns its return code, stdout and stderr
+    async def run_process(self, service, args, input=None):
+        async with self.semaphore(service):
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            out, err = await process.communicate(input)
+
+            return process.returncode, out, err
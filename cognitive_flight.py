@@ -0,0 +1,26 @@
+# coding: utf-8
+
+import asyncio
+
+
+# Lets the concurrent calls with the same key share a single call and its result.
+# It is used from the engine's event loop only, so it does not need a lock.
+class SingleFlight(object):
+    def __init__(self):
+        self._calls = {}
+
+    # Runs the coroutine function unless a call with the same key is already in flight, and returns its result
+    async def do(self, key, func, *args, **kwargs):
+        future = self._calls.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = future
+            future.add_done_callback(lambda x: self._calls.pop(key, None))
+
+        # A caller that is cancelled leaves the call running for the others
+        return await asyncio.shield(future)
+
+    @property
+    def num_in_flight(self):
+        return len(self._calls)
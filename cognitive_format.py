@@ -0,0 +1,94 @@
+# coding: utf-8
+
+# Builds the replies of the image tasks from the decoded results
+
+clip_art_types = {0: "non-clip-art", 1: "ambiguous", 2: "normal-clip-art", 3: "good-clip-art"}
+
+
+# Joins the words like "a, b and c"
+def join_words(words):
+    if len(words) > 1:
+        return "%s and %s" % (", ".join(words[:-1]), words[-1])
+
+    return "".join(words)
+
+
+def format_categories(analysis):
+    if len(analysis.categories) == 1:
+        text = "I think it belongs to the category of "
+    else:
+        text = "I think it belongs to the categories of "
+
+    return text + join_words([x.name for x in analysis.categories])
+
+
+def format_tags(analysis):
+    if not analysis.tags:
+        return "I can't find any tags for it."
+    elif len(analysis.tags) == 1:
+        text = "I think it is "
+    else:
+        text = "I think it has tags of "
+
+    return text + join_words([x.hashtag for x in analysis.tags])
+
+
+def format_description(analysis):
+    landmark = analysis.landmark
+
+    if landmark:
+        return "I'll say it's the %s." % landmark
+
+    return "I'll say it's %s." % analysis.caption
+
+
+def format_colour(analysis):
+    colour = analysis.colour
+    is_bw = "This is a black and white image." if colour.is_bw else "This is not a black and white image."
+
+    return "%s\n\n%s and %s dominate the foreground and background respectively. The dominant colours include %s." \
+           "\n\nAnd the accent colour is #%s." % (is_bw, colour.foreground, colour.background.lower(),
+                                                  ", ".join(x.lower() for x in colour.dominant), colour.accent)
+
+
+def format_image_type(analysis):
+    clip_art_type = clip_art_types[analysis.image_type.clip_art_type]
+
+    if clip_art_type == "ambiguous":
+        text = "I'm not sure if it's a clip art or not, but "
+    else:
+        text = "I think it's a %s, and " % clip_art_type
+
+    if analysis.image_type.line_drawing:
+        return text + "I think it's a line drawing."
+
+    return text + "I think it's not a line drawing."
+
+
+# Summary of all the visual features for the full analysis
+def format_summary(analysis):
+    landmark = analysis.landmark
+    colour = analysis.colour
+    lines = ["Here is a summary of it:\n",
+             "%s: %s" % ("Category" if len(analysis.categories) == 1 else "Categories",
+                         join_words([x.name for x in analysis.categories])),
+             "%s: %s\n" % ("Tag" if len(analysis.tags) == 1 else "Tags",
+                           join_words([x.hashtag for x in analysis.tags])),
+             "Description: it's the %s.\n" % landmark if landmark else "Description: it's %s.\n" % analysis.caption,
+             "Clip art type: %s" % clip_art_types[analysis.image_type.clip_art_type],
+             "Line drawing: %s\n" % ("yes" if analysis.image_type.line_drawing else "no"),
+             "Black and white image: %s" % ("yes" if colour.is_bw else "no"),
+             "Foreground dominant colour: %s" % colour.foreground.lower(),
+             "Background dominant colour: %s" % colour.background.lower(),
+             "Dominant colours: %s" % ", ".join(x.lower() for x in colour.dominant),
+             "Accent colour: #%s\n" % colour.accent,
+             "I am still analysing the faces on the image. You can look at the summary while you are waiting."]
+
+    return "\n".join(lines)
+
+
+def format_text(text_result):
+    if not text_result.lines:
+        return "I could not find any text on the image."
+
+    return "\n".join(text_result.lines)
@@ -0,0 +1,70 @@
+# coding: utf-8
+
+import requests
+import threading
+
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+
+# Thread safe HTTP client that keeps connections alive in a pool per host and retries transient failures
+class HttpClient(object):
+    def __init__(self, pool_size=10, num_hosts=10, retries=3, backoff=0.5, timeout=30, cookies=True):
+        self.pool_size = pool_size
+        self.num_hosts = num_hosts
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cookies = cookies
+        self._session = None
+        self._lock = threading.Lock()
+
+    # Returns the shared session, creating it on first use
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+
+        return self._session
+
+    def _create_session(self):
+        retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.num_hosts, pool_maxsize=self.pool_size, max_retries=retry,
+                              pool_block=True)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # Refuses all cookies, so that the jar does not fill up with the cookies of every site requested
+        if not self.cookies:
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        return self.session.request(method=method, url=url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("get", url, **kwargs)
+
+    # Opens a connection to the host of each URL so that the first requests do not wait for the TLS handshakes
+    def warm_up(self, urls, timeout=5):
+        for host in {"%s://%s/" % urlsplit(x)[:2] for x in urls if x}:
+            try:
+                self.request("head", host, timeout=timeout).close()
+            except requests.RequestException:
+                pass
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
@@ -0,0 +1,53 @@
+# coding: utf-8
+
+import io
+
+from cognitive_lazy import lazy_import
+
+# Pillow is imported on the first image
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+supported_formats = ("JPEG", "PNG", "GIF", "BMP")
+
+
+# Checks if the error comes from image data that Pillow cannot open, which fails the same way on every task
+def is_image_error(e):
+    # Pillow before 7.0 raises a plain IOError for the data it cannot identify
+    return isinstance(e, (getattr(Image, "UnidentifiedImageError", ()), Image.DecompressionBombError))
+
+
+# Downscales the image so that its longest side fits in max_size and re-encodes it as JPEG.
+# The original bytes are returned if they are already small enough and in a format supported by the APIs.
+def prepare_image(data, max_size, quality=85, size_limit=4000000):
+    im = Image.open(io.BytesIO(data))
+
+    if im.format in supported_formats and max(im.size) <= max_size and len(data) <= size_limit:
+        return data
+
+    # Lets the JPEG decoder skip the detail that is thrown away anyway
+    if im.format == "JPEG":
+        im.draft("RGB", (max_size, max_size))
+
+    im = ImageOps.exif_transpose(im)
+
+    if im.mode in ("RGBA", "LA", "P"):
+        im = im.convert("RGBA")
+        background = Image.new("RGB", im.size, (255, 255, 255))
+        background.paste(im, mask=im.split()[-1])
+        im = background
+    elif im.mode != "RGB":
+        im = im.convert("RGB")
+
+    im.thumbnail((max_size, max_size), Image.BICUBIC)
+
+    while True:
+        image_buf = io.BytesIO()
+        im.save(image_buf, "JPEG", quality=quality, optimize=True)
+
+        if image_buf.tell() <= size_limit or quality <= 40:
+            break
+
+        quality -= 15
+
+    return image_buf.getvalue()
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import logging
+import mimetypes
+import requests
+
+logger = logging.getLogger(__name__)
+
+FETCH_OK = "ok"
+FETCH_FAILED = "failed"
+FETCH_TOO_LARGE = "too_large"
+FETCH_UNSUPPORTED = "unsupported"
+
+# Number of bytes needed to recognise the file type
+sniff_size = 32
+
+# Content types that do not tell the file type, which is then guessed from the extension of the URL
+generic_content_types = ("application/octet-stream", "binary/octet-stream")
+
+
+# Returns "image" or "audio" based on the signature at the start of the file, or None if it is not recognised
+def sniff_file_type(head):
+    if head.startswith((b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*")):
+        return "image"
+    elif head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image"
+    elif head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return "audio"
+    elif head.startswith((b"ID3", b"OggS", b"fLaC", b"#!AMR", b"FORM")):
+        return "audio"
+    elif len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        # MPEG audio or ADTS AAC frame sync
+        return "audio"
+    elif head[4:8] == b"ftyp" and head[8:11] in (b"M4A", b"M4B", b"3gp"):
+        return "audio"
+
+    return None
+
+
+# Returns "image" or "audio" from the content type, or from the file extension of the URL if the server does not say
+def guess_file_type(url, content_type):
+    mimetype = content_type.split(";")[0].strip().lower() if content_type else ""
+
+    if not mimetype or mimetype in generic_content_types:
+        mimetype = mimetypes.guess_type(url)[0] or ""
+
+    if mimetype.startswith("image"):
+        return "image"
+    elif mimetype.startswith("audio"):
+        return "audio"
+
+    return None
+
+
+# Downloads the image or audio of the URL in a single request.
+# Stops as soon as the file is larger than the size limit of its type, and returns (status, file_type, data).
+def fetch_url(http, url, size_limits, chunk_size=65536):
+    try:
+        response = http.get(url, stream=True)
+    except requests.RequestException as e:
+        logger.warning("Failed to fetch %s: %s" % (url, e))
+
+        return FETCH_FAILED, None, None
+
+    with response:
+        if response.status_code not in range(200, 209):
+            return FETCH_FAILED, None, None
+
+        file_type = None
+        size_limit = None
+        content_length = response.headers.get("content-length")
+        chunks = []
+        size = 0
+
+        try:
+            for chunk in response.iter_content(chunk_size):
+                chunks.append(chunk)
+                size += len(chunk)
+
+                if file_type is None and size >= sniff_size:
+                    file_type, size_limit = _check_type(url, response, b"".join(chunks), size_limits)
+
+                    if file_type is None:
+                        return FETCH_UNSUPPORTED, None, None
+                    elif content_length and content_length.isdigit() and int(content_length) > size_limit:
+                        return FETCH_TOO_LARGE, file_type, None
+
+                if size_limit is not None and size > size_limit:
+                    return FETCH_TOO_LARGE, file_type, None
+        except requests.RequestException as e:
+            logger.warning("Failed to fetch %s: %s" % (url, e))
+
+            return FETCH_FAILED, file_type, None
+
+    data = b"".join(chunks)
+
+    # Files smaller than the sniff size
+    if file_type is None:
+        file_type, size_limit = _check_type(url, response, data, size_limits)
+
+        if file_type is None:
+            return FETCH_UNSUPPORTED, None, None
+
+    return FETCH_OK, file_type, data
+
+
+def _check_type(url, response, head, size_limits):
+    file_type = sniff_file_type(head[:sniff_size]) or guess_file_type(url, response.headers.get("content-type"))
+
+    # The file is not of a type that the caller takes, e.g. a re-fetched image URL that now gives audio
+    if file_type not in size_limits:
+        return None, None
+
+    return file_type, size_limits[file_type]
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Subscription key with a token bucket that matches the rate tier of the key
+class Key(object):
+    __slots__ = ("token", "rate", "capacity", "tokens", "updated", "cooldown_until", "failures")
+
+    def __init__(self, token, rate):
+        self.token = token
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cooldown_until = 0
+        self.failures = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+# Spreads the requests of a service across its keys, and rests a key for a while when it runs out of quota.
+# It is used from the engine's event loop only, so it does not need a lock.
+class KeyPool(object):
+    def __init__(self, keys, cooldown=60, max_cooldown=3600):
+        self.keys = keys
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+    # Waits for a key with a free request in its bucket, returns None if all the keys are resting
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            available = []
+            wait = None
+
+            for key in self.keys:
+                if key.cooldown_until > now:
+                    continue
+
+                key.refill(now)
+
+                if key.tokens >= 1:
+                    available.append(key)
+                else:
+                    key_wait = (1 - key.tokens) / key.rate
+
+                    if wait is None or key_wait < wait:
+                        wait = key_wait
+
+            if available:
+                key = max(available, key=lambda x: x.tokens / x.capacity)
+                key.tokens -= 1
+
+                return key
+            elif wait is None:
+                return None
+
+            await asyncio.sleep(wait)
+
+    # Takes a request from the bucket of the given key if it has one and returns 0, or else returns the seconds until
+    # it can be used. For requests that have to use a certain key, like reading the operation that the key started.
+    def reserve(self, key):
+        now = time.monotonic()
+
+        if key.cooldown_until > now:
+            return key.cooldown_until - now
+
+        key.refill(now)
+
+        if key.tokens >= 1:
+            key.tokens -= 1
+
+            return 0
+
+        return (1 - key.tokens) / key.rate
+
+    # Returns the key with the token, or None if it is not one of the keys
+    def find(self, token):
+        return next((x for x in self.keys if x.token == token), None)
+
+    # Updates the key with the status of its response
+    def report(self, key, status_code, retry_after=None):
+        if status_code in (403, 429):
+            key.failures += 1
+
+            try:
+                cooldown = float(retry_after)
+            except (TypeError, ValueError):
+                cooldown = min(self.cooldown * 2 ** (key.failures - 1), self.max_cooldown)
+
+            key.cooldown_until = time.monotonic() + cooldown
+            logger.warning("Subscription key ...%s is resting for %d seconds after a %d response" %
+                           (key.token[-4:], cooldown, status_code))
+        else:
+            key.failures = 0
+
+
+# Reads the keys from a comma separated list of "key" or "key:requests_per_second"
+def parse_keys(value, default_rate):
+    keys = []
+
+    if not value:
+        return keys
+
+    for item in value.split(","):
+        token, _, rate = item.strip().partition(":")
+
+        if token:
+            keys.append(Key(token, float(rate) if rate else default_rate))
+
+    return keys
@@ -0,0 +1,126 @@
+# coding: utf-8
+
+import re
+
+from cognitive_lazy import lazy_import
+
+# The statistical detector is only needed for the text that the scripts do not settle
+langdetect = lazy_import("langdetect")
+
+accepted_langs = ("en", "zh-cn", "zh-tw")
+
+# Common English words that are rarely words of the other languages written in Latin letters
+english_words = frozenset("""
+    the and are were be been being have does did not this that these those with you your it its it's i'm i've i'd i'll
+    we our they their them what which who when where why how can could would should won't don't doesn't didn't can't
+    isn't aren't wasn't please thanks thank very good great there here like more some any about because really work
+    works working picture pictures feature features love nice awesome useful helpful wrong doesnt dont cant need think
+    much many than only anything something out get got use using used send voice way make takes while since yesterday
+    today hello thx
+""".split())
+
+# Common English words that are words of other languages too, like German "am", "an" and "was", Dutch "of" and
+# "want", Portuguese "do" or the French "image" and "photo". They count towards the share of English words, but do not
+# make text English on their own.
+shared_words = frozenset("""
+    i a to of for in on at by an am as is so or if all also but was will had has do my from bad app bot time made over
+    add hi hey ok okay lol just help want sent image images photo photos cool super text message messages support
+""".split())
+
+word_pattern = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+
+
+# Returns "en" or "zh" if the scripts of the text show that it is English or Chinese, "other" if they show that it is
+# not, or None if they do not tell
+def classify_script(text, min_words=3, english_ratio=0.25):
+    if text.isascii():
+        return classify_words(text, min_words, english_ratio)
+
+    han = kana = hangul = latin = accented = other = 0
+
+    for c in text:
+        if not c.isalpha():
+            continue
+
+        code = ord(c)
+
+        if code < 0x250:
+            latin += 1
+
+            if code >= 0x80:
+                accented += 1
+        elif 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF or 0xF900 <= code <= 0xFAFF or \
+                0x20000 <= code <= 0x2FA1F:
+            han += 1
+        elif 0x3040 <= code <= 0x30FF or 0x31F0 <= code <= 0x31FF:
+            kana += 1
+        elif 0xAC00 <= code <= 0xD7AF or 0x1100 <= code <= 0x11FF or 0x3130 <= code <= 0x318F:
+            hangul += 1
+        else:
+            other += 1
+
+    letters = han + kana + hangul + latin + other
+
+    if letters == 0:
+        return "other"
+    elif kana + hangul >= letters * 0.1:
+        return "other"
+    elif han >= letters * 0.3:
+        return "zh"
+    elif other >= letters * 0.5:
+        return "other"
+    elif latin >= letters * 0.9:
+        return classify_words(text, min_words, english_ratio, accented > 0)
+
+    return None
+
+
+# Tells English from the other languages written in Latin letters by how many of the words are common English words.
+# English has few accented letters, so accented text that does not read as English is taken as another language.
+def classify_words(text, min_words=3, english_ratio=0.25, accented=False):
+    words = word_pattern.findall(text.lower())
+
+    if not words:
+        return "other"
+
+    strong_hits = sum(1 for x in words if x in english_words)
+    hits = strong_hits + sum(1 for x in words if x in shared_words)
+
+    # Too few words to go by their share, unless they are all English
+    if len(words) < min_words:
+        return "en" if strong_hits and hits == len(words) else None
+
+    # A single English word among the shared ones is not enough, unless they make up most of the text
+    if strong_hits and hits >= len(words) * english_ratio and (strong_hits >= 2 or hits * 2 > len(words)):
+        return "en"
+    elif accented or (hits == 0 and len(words) >= min_words * 2):
+        return "other"
+
+    return None
+
+
+# Returns the languages that langdetect finds in the text, the most likely first
+def detect_langs(text):
+    try:
+        return [x.lang for x in langdetect.detect_langs(text)]
+    except langdetect.lang_detect_exception.LangDetectException:
+        return []
+
+
+# Reads the language profiles and makes the detection deterministic
+def load_profiles():
+    langdetect.DetectorFactory.seed = 0
+    langdetect.detector_factory.init_factory()
+
+
+# Checks if the text is in one of the accepted languages, by its scripts and words and then by langdetect if needed
+def is_accepted_language(text):
+    lang = classify_script(text)
+
+    if lang is None:
+        if langdetect.DetectorFactory.seed is None:
+            langdetect.DetectorFactory.seed = 0
+
+        return any(x in accepted_langs for x in detect_langs(text))
+
+    return lang in ("en", "zh")
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Stands in for a module until one of its attributes is used, so that a heavy module is only imported when needed
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def load(self):
+        module = self.__dict__["_module"]
+
+        if module is None:
+            with self.__dict__["_lock"]:
+                module = self.__dict__["_module"]
+
+                if module is None:
+                    module = importlib.import_module(self.__dict__["_name"])
+                    self.__dict__["_module"] = module
+
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.load(), name, value)
+
+    def __repr__(self):
+        return "<lazy module %r>" % self.__dict__["_name"]
+
+
+def lazy_import(name):
+    return LazyModule(name)
+
+
+# Runs the slow first-use work (imports, data files, connections) in the background once the bot is up, and tells
+# whether it has finished for the readiness probe
+class WarmUp(object):
+    def __init__(self):
+        self._tasks = []
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._done.is_set()
+
+    def add(self, name, func, *args):
+        self._tasks.append((name, func, args))
+
+    # Runs the tasks in the background, or in this thread if blocking
+    def start(self, blocking=False):
+        if blocking:
+            self._run()
+        elif self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+            self._thread.start()
+
+    # Skips the warm up, the pieces are then loaded on first use
+    def skip(self):
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _run(self):
+        start = time.perf_counter()
+
+        for name, func, args in self._tasks:
+            task_start = time.perf_counter()
+
+            # A piece that fails to warm up is loaded on first use instead
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning("Failed to warm up %s: %s" % (name, e))
+            else:
+                logger.info("Warmed up %s in %.2f seconds" % (name, time.perf_counter() - task_start))
+
+        self._done.set()
+        logger.info("Warm up finished in %.2f seconds" % (time.perf_counter() - start))
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+import logging
+import queue
+import threading
+import time
+
+from email.message import EmailMessage
+
+from cognitive_lazy import lazy_import
+
+logger = logging.getLogger(__name__)
+smtplib = lazy_import("smtplib")
+
+
+# Sends emails from a background thread over one connection that is kept open between them. The messages that arrive
+# within the batch window of each other are sent together as one digest, and failed sends are retried.
+class Mailer(object):
+    def __init__(self, host, port=0, starttls=True, username=None, password=None, sender=None, recipient=None,
+                 subject="", batch_window=5, max_batch=50, retries=5, retry_delay=5, idle_timeout=60, timeout=30,
+                 max_queue=1000):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._queue = queue.Queue(max_queue)
+        self._conn = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mailer", daemon=True)
+            self._thread.start()
+
+    # Queues the text to be sent, returns False if the queue is full
+    def send(self, text):
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            logger.error("Mail queue is full, dropping: %s" % text)
+
+            return False
+
+        return True
+
+    # Sends the queued messages and stops the thread
+    def close(self, timeout=60):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        stopped = False
+
+        while not stopped:
+            # Closes the connection once it has been idle, the server would drop it anyway
+            try:
+                text = self._queue.get(timeout=self.idle_timeout if self._conn else None)
+            except queue.Empty:
+                self._disconnect()
+
+                continue
+
+            if text is None:
+                break
+
+            batch = [text]
+            deadline = time.monotonic() + self.batch_window
+
+            while len(batch) < self.max_batch:
+                try:
+                    text = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+                if text is None:
+                    stopped = True
+
+                    break
+
+                batch.append(text)
+
+            self._send_batch(batch)
+
+        self._disconnect()
+
+    def _send_batch(self, batch):
+        message = self._make_message(batch)
+
+        for attempt in range(self.retries + 1):
+            try:
+                if self._conn is None:
+                    self._connect()
+
+                self._conn.send_message(message)
+                logger.info("Sent %d messages by email" % len(batch))
+
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                logger.warning("Failed to send email (attempt %d): %s" % (attempt + 1, e))
+                self._disconnect()
+
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+
+        logger.error("Gave up sending email, dropping: %s" % "\n\n".join(batch))
+
+    def _make_message(self, batch):
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = self.recipient
+
+        if len(batch) == 1:
+            message["Subject"] = self.subject
+            message.set_content(batch[0])
+        else:
+            message["Subject"] = "%s (%d messages)" % (self.subject, len(batch))
+            message.set_content(("\n\n%s\n\n" % ("-" * 40)).join(batch))
+
+        return message
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            conn.ehlo()
+
+            if self.starttls:
+                conn.starttls()
+                conn.ehlo()
+
+            if self.password:
+                conn.login(self.username, self.password)
+        except Exception:
+            conn.close()
+            raise
+
+        self._conn = conn
+
+    def _disconnect(self):
+        if self._conn is None:
+            return
+
+        try:
+            self._conn.quit()
+        except (smtplib.SMTPException, OSError):
+            self._conn.close()
+
+        self._conn = None
@@ -0,0 +1,213 @@
+# coding: utf-8
+
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    items = ["%s=\"%s\"" % (name, _escape(value)) for name, value in zip(names, values)]
+
+    if extra:
+        items.append("%s=\"%s\"" % extra)
+
+    return "{%s}" % ",".join(items) if items else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.extend(self._render_value(labels, value))
+
+        return lines
+
+    def _render_value(self, labels, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.label_names, labels), _format_value(value))]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    # Counts the block as in progress while it runs
+    @contextmanager
+    def track(self, *labels):
+        self.inc(*labels)
+
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=default_buckets):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        with self._lock:
+            if labels not in self._values:
+                self._values[labels] = [[0] * len(self.buckets), 0, 0]
+
+            entry = self._values[labels]
+            entry[1] += value
+            entry[2] += 1
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+
+    # Observes how long the block takes, in seconds
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def _render_value(self, labels, value):
+        counts, total, count = value
+        name_labels = _format_labels(self.label_names, labels)
+        lines = []
+
+        for bound, bucket_count in zip(self.buckets, counts):
+            lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.label_names, labels, ("le", bound)),
+                                             bucket_count))
+
+        lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.label_names, labels, ("le", "+Inf")), count))
+        lines.append("%s_sum%s %s" % (self.name, name_labels, _format_value(float(total))))
+        lines.append("%s_count%s %d" % (self.name, name_labels, count))
+
+        return lines
+
+
+# Keeps the metrics and renders them in the Prometheus text format
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, label_names=()):
+        return self._add(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=()):
+        return self._add(Gauge(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=default_buckets):
+        return self._add(Histogram(name, help, label_names, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+
+        return metric
+
+    def render(self):
+        lines = []
+
+        for metric in self._metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+# Serves the metrics on /metrics and the readiness on /ready from a background thread
+class MetricsServer(object):
+    def __init__(self, registry, port, host="0.0.0.0", ready=None):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.ready = ready
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        registry = self.registry
+        ready = self.ready
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+
+                if path == "/metrics":
+                    self.send_body(200, registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+                elif path == "/ready":
+                    # Answers 503 until the bot has warmed up, for the readiness probe
+                    if ready is None or ready():
+                        self.send_body(200, "ready\n", "text/plain; charset=utf-8")
+                    else:
+                        self.send_body(503, "warming up\n", "text/plain; charset=utf-8")
+                else:
+                    self.send_error(404)
+
+            def send_body(self, code, text, content_type):
+                body = text.encode("utf8")
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logger.info("Serving metrics and readiness on port %d" % self.port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._thread = None
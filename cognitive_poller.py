@@ -0,0 +1,151 @@
+# coding: utf-8
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Operation(object):
+    __slots__ = ("url", "headers", "key", "future", "interval", "next_poll", "deadline")
+
+    def __init__(self, url, headers, key, future, interval, next_poll, deadline):
+        self.url = url
+        self.headers = headers
+        self.key = key
+        self.future = future
+        self.interval = interval
+        self.next_poll = next_poll
+        self.deadline = deadline
+
+
+# Polls long running operations (e.g. handwritten text recognition) on the engine until they finish.
+# All the operations that are due are polled together on each tick, and each one backs off while it keeps running.
+# With a key pool, the polls count against the rate of the key that started the operation, and an operation whose key
+# has run out of quota is polled again once the key can be used.
+class OperationPoller(object):
+    pending_statuses = ("Not started", "Running")
+
+    def __init__(self, engine, service="vision", interval=1, max_interval=10, backoff=1.5, timeout=120, pool=None):
+        self.engine = engine
+        self.service = service
+        self.pool = pool
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self._operations = {}
+        self._wakeup = None
+        self._task = None
+
+    # Waits for the operation to finish and returns its final response, raises asyncio.TimeoutError after the timeout
+    async def wait(self, url, headers, key=None):
+        loop = self.engine.loop
+
+        if url not in self._operations:
+            now = loop.time()
+            self._operations[url] = Operation(url, headers, key, loop.create_future(), self.interval,
+                                              now + self.interval, now + self.timeout)
+
+            if self._wakeup is None:
+                self._wakeup = asyncio.Event()
+
+            if self._task is None:
+                self._task = loop.create_task(self._run())
+            else:
+                self._wakeup.set()
+
+        return await asyncio.shield(self._operations[url].future)
+
+    @property
+    def num_pending(self):
+        return len(self._operations)
+
+    async def _run(self):
+        loop = self.engine.loop
+
+        try:
+            while self._operations:
+                now = loop.time()
+                due = [x for x in self._operations.values() if x.next_poll <= now]
+
+                if due:
+                    await asyncio.gather(*[self._poll(x) for x in due])
+
+                    continue
+
+                self._wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           min(x.next_poll for x in self._operations.values()) - now)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._task = None
+
+    async def _poll(self, operation):
+        use_pool = self.pool is not None and operation.key is not None
+
+        # Waits for the key of the operation to have a free request in its bucket
+        if use_pool:
+            wait = self.pool.reserve(operation.key)
+
+            if wait > 0:
+                self._reschedule(operation, wait)
+
+                return
+
+        try:
+            response = await self.engine.request(self.service, "get", operation.url, headers=operation.headers)
+        except Exception as e:
+            logger.warning("Failed to poll operation %s: %s" % (operation.url, e))
+            response = None
+
+        if response is not None and use_pool:
+            self.pool.report(operation.key, response.status_code, response.headers.get("Retry-After"))
+
+        if response is not None and response.status_code in (403, 429):
+            # The key has run out of quota for now, the operation itself is still running
+            self._reschedule(operation, self._get_retry_after(response, operation.interval))
+        elif response is not None and not self._is_pending(response):
+            self._finish(operation, response)
+        else:
+            operation.interval = min(operation.interval * self.backoff, self.max_interval)
+            self._reschedule(operation, operation.interval)
+
+    # Polls the operation again after the delay, or gives up on it once its deadline has passed
+    def _reschedule(self, operation, delay):
+        now = self.engine.loop.time()
+
+        if now >= operation.deadline:
+            self._finish(operation, None)
+        else:
+            operation.next_poll = min(now + delay, operation.deadline)
+
+    @staticmethod
+    def _get_retry_after(response, default):
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return default
+
+    def _is_pending(self, response):
+        if response.status_code != 200 or "application/json" not in response.headers.get("content-type", "").lower():
+            return False
+
+        try:
+            return response.json().get("status") in self.pending_statuses
+        except ValueError:
+            return False
+
+    def _finish(self, operation, response):
+        del self._operations[operation.url]
+
+        if operation.future.done():
+            return
+
+        if response is None:
+            operation.future.set_exception(asyncio.TimeoutError())
+        else:
+            operation.future.set_result(response)
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+import io
+import operator
+import os
+import threading
+
+from cognitive_lazy import lazy_import
+
+# Pillow is imported on the first image
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
+
+font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "segoeuil.ttf")
+font_sizes = (12, 16, 20, 24, 32, 40, 48)
+label_fill = (241, 241, 242, 170)
+default_text_colour = (25, 149, 173)
+
+
+# Draws the face annotations onto an image, keeping the fonts loaded between calls
+class FaceRenderer(object):
+    def __init__(self, quality=85, max_size=1280, font_file=font_path):
+        self.quality = quality
+        self.max_size = max_size
+        self.font_file = font_file
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    # Returns the font of the size, loading it on first use
+    def get_font(self, size):
+        font = self._fonts.get(size)
+
+        if font is None:
+            with self._lock:
+                font = self._fonts.get(size)
+
+                if font is None:
+                    font = ImageFont.truetype(self.font_file, size)
+                    self._fonts[size] = font
+
+        return font
+
+    # Loads the fonts up front so that the first user does not wait for them
+    def warm_up(self):
+        for size in font_sizes:
+            self.get_font(size)
+
+    # Returns the label font size that suits the image size, roughly 16 pixels for a 640 pixels image
+    @staticmethod
+    def get_font_size(width, height):
+        target = min(width, height) / 40
+
+        return min(font_sizes, key=lambda x: abs(x - target))
+
+    # Annotates the faces on the image and returns the annotated image in a JPEG buffer
+    def render(self, data, faces, face_info, accent_colour=None):
+        im = Image.open(io.BytesIO(data))
+        original_width = im.width
+
+        if self.max_size and max(im.size) > self.max_size:
+            if im.format == "JPEG":
+                im.draft("RGB", (self.max_size, self.max_size))
+
+            if max(im.size) > self.max_size:
+                im.thumbnail((self.max_size, self.max_size), Image.BICUBIC)
+
+        # The face rectangles are relative to the original size
+        scale = im.width / original_width
+
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+
+        draw = ImageDraw.Draw(im, "RGBA")
+        font = self.get_font(self.get_font_size(im.width, im.height))
+        text_colour = accent_colour if accent_colour else default_text_colour
+
+        for face in faces:
+            face_rectangle = face["faceRectangle"]
+            left = face_rectangle["left"]
+            top = face_rectangle["top"]
+            width = face_rectangle["width"]
+            height = face_rectangle["height"]
+            text = ""
+
+            if (left, top, width, height) in face_info:
+                age, gender = face_info[(left, top, width, height)]
+                text += "%s %d\n" % (gender, age)
+
+            text += max(face["scores"].items(), key=operator.itemgetter(1))[0].capitalize()
+
+            left, top, width, height = [int(round(x * scale)) for x in (left, top, width, height)]
+            text_width, text_height = self.get_text_size(draw, text, font)
+            top_offset = max(top - text_height - 4, 0)
+
+            draw.rectangle([left, top, left + width, top + height])
+            draw.rectangle([left, top_offset, left + text_width, top_offset + text_height], fill=label_fill)
+            draw.multiline_text((left, top_offset), text, text_colour, font)
+
+        out_image = io.BytesIO()
+        im.save(out_image, "JPEG", quality=self.quality)
+        out_image.seek(0)
+
+        return out_image
+
+    @staticmethod
+    def get_text_size(draw, text, font):
+        # multiline_textsize was removed in Pillow 10
+        if hasattr(draw, "multiline_textbbox"):
+            bbox = draw.multiline_textbbox((0, 0), text, font)
+
+            return bbox[2], bbox[3]
+
+        return draw.multiline_textsize(text, font)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+# The results of the APIs, decoded once from their JSON responses so that the tasks and the cache share them
+
+
+class Landmark(object):
+    __slots__ = ("name", "confidence")
+
+    def __init__(self, name, confidence):
+        self.name = name
+        self.confidence = confidence
+
+
+class Category(object):
+    __slots__ = ("name", "score", "landmarks")
+
+    def __init__(self, name, score, landmarks):
+        self.name = name
+        self.score = score
+        self.landmarks = landmarks
+
+    @classmethod
+    def from_json(cls, category):
+        detail = category.get("detail") or {}
+        landmarks = [Landmark(x["name"], x["confidence"]) for x in detail.get("landmarks", ())]
+
+        # The category names are like "outdoor_city" and "building_"
+        return cls(category["name"].rstrip("_").replace("_", " "), category.get("score", 0), landmarks)
+
+
+class Tag(object):
+    __slots__ = ("name", "confidence")
+
+    def __init__(self, name, confidence):
+        self.name = name
+        self.confidence = confidence
+
+    @property
+    def hashtag(self):
+        return "#" + self.name.rstrip("_").replace(" ", "")
+
+
+class Caption(object):
+    __slots__ = ("text", "confidence")
+
+    def __init__(self, text, confidence):
+        self.text = text
+        self.confidence = confidence
+
+
+class Colour(object):
+    __slots__ = ("foreground", "background", "dominant", "accent", "is_bw")
+
+    def __init__(self, foreground, background, dominant, accent, is_bw):
+        self.foreground = foreground
+        self.background = background
+        self.dominant = dominant
+        self.accent = accent
+        self.is_bw = is_bw
+
+    @classmethod
+    def from_json(cls, colour):
+        return cls(colour["dominantColorForeground"], colour["dominantColorBackground"],
+                   tuple(colour["dominantColors"]), colour["accentColor"], colour["isBWImg"])
+
+
+class ImageType(object):
+    __slots__ = ("clip_art_type", "line_drawing")
+
+    def __init__(self, clip_art_type, line_drawing):
+        self.clip_art_type = clip_art_type
+        self.line_drawing = line_drawing
+
+
+class Face(object):
+    __slots__ = ("age", "gender", "rectangle")
+
+    def __init__(self, age, gender, rectangle):
+        self.age = age
+        self.gender = gender
+        self.rectangle = rectangle
+
+    @classmethod
+    def from_json(cls, face):
+        rect = face["faceRectangle"]
+
+        return cls(face.get("age"), face.get("gender"), (rect["left"], rect["top"], rect["width"], rect["height"]))
+
+
+# Result of the Computer Vision analysis with all the visual features
+class ImageAnalysis(object):
+    __slots__ = ("categories", "tags", "captions", "colour", "image_type", "faces")
+
+    def __init__(self, categories, tags, captions, colour, image_type, faces):
+        self.categories = categories
+        self.tags = tags
+        self.captions = captions
+        self.colour = colour
+        self.image_type = image_type
+        self.faces = faces
+
+    @classmethod
+    def from_json(cls, result):
+        description = result.get("description") or {}
+        colour = result.get("color")
+        image_type = result.get("imageType")
+
+        return cls([Category.from_json(x) for x in result.get("categories", ())],
+                   [Tag(x["name"], x.get("confidence", 0)) for x in result.get("tags", ())],
+                   [Caption(x["text"], x["confidence"]) for x in description.get("captions", ())],
+                   Colour.from_json(colour) if colour else None,
+                   ImageType(image_type["clipArtType"], bool(image_type["lineDrawingType"])) if image_type else None,
+                   [Face.from_json(x) for x in result.get("faces", ())])
+
+    # Returns the name of the landmark that the analysis is the most confident of, if any
+    @property
+    def landmark(self):
+        landmarks = [x for category in self.categories for x in category.landmarks if x.confidence > 0]
+
+        return max(landmarks, key=lambda x: x.confidence).name if landmarks else None
+
+    # Returns the caption that the analysis is the most confident of, if any
+    @property
+    def caption(self):
+        captions = [x for x in self.captions if x.confidence > 0]
+
+        return max(captions, key=lambda x: x.confidence).text if captions else None
+
+
+# Lines of text read from an image
+class TextResult(object):
+    __slots__ = ("lines",)
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    # Reads the result of the OCR endpoint, which has the words of each line of each region
+    @classmethod
+    def from_ocr(cls, result):
+        return cls([" ".join(word["text"] for word in line["words"]) for region in result.get("regions", ())
+                    for line in region["lines"]])
+
+    # Reads the result of a handwritten text operation
+    @classmethod
+    def from_handwritten(cls, result):
+        return cls([line["text"] for line in result["recognitionResult"]["lines"]])
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value):
+    return int(hashlib.md5(str(value).encode("utf8")).hexdigest()[:16], 16)
+
+
+# Consistent hash ring, so that changing the number of shards only moves the keys of the shards that were added or
+# removed rather than almost all of them
+class HashRing(object):
+    def __init__(self, shards, replicas=64):
+        points = sorted((_hash("%s-%d" % (shard, i)), shard) for shard in shards for i in range(replicas))
+        self._hashes = [x[0] for x in points]
+        self._shards = [x[1] for x in points]
+
+    def get_shard(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+
+        return self._shards[i]
+
+
+# Hands the updates to worker processes, sending all the updates of a chat to the same worker so that its
+# conversation stays in one process
+class ShardRouter(object):
+    def __init__(self, num_workers, worker_main, replicas=64):
+        self.num_workers = num_workers
+        self.worker_main = worker_main
+        self.ring = HashRing(range(num_workers), replicas)
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = []
+        self._processes = []
+
+    def start(self):
+        for i in range(self.num_workers):
+            queue = self._context.Queue()
+            process = self._context.Process(target=self.worker_main, args=(i, queue), name="worker-%d" % i,
+                                            daemon=True)
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+        logger.info("Started %d worker processes" % self.num_workers)
+
+    # Sends the update to the worker of the key, as JSON
+    def route(self, key, update):
+        shard = self.ring.get_shard(key)
+
+        if not self._processes[shard].is_alive():
+            logger.error("Worker %d is not running, dropping update %d" % (shard, update.update_id))
+
+            return
+
+        self._queues[shard].put(update.to_json())
+
+    # Tells the workers to finish the updates they have and waits for them to stop
+    def stop(self, timeout=30):
+        for queue in self._queues:
+            queue.put(None)
+
+        for process in self._processes:
+            process.join(timeout)
+
+            if process.is_alive():
+                process.terminate()
+
+        self._queues = []
+        self._processes = []
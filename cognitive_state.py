@@ -0,0 +1,340 @@
+# coding: utf-8
+
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+
+# Keeps the state in memory only
+class MemoryBackend(object):
+    persistent = False
+
+    def load(self, namespace, key):
+        return None
+
+    def save(self, changes):
+        pass
+
+    def touch(self, keys):
+        pass
+
+    def expire(self, before):
+        pass
+
+    def close(self):
+        pass
+
+
+# Keeps the state in an SQLite database, so that it survives restarts and can be shared between processes
+class SQLiteBackend(object):
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS state (namespace TEXT, key TEXT, value BLOB, updated REAL, "
+                               "PRIMARY KEY (namespace, key))")
+
+    def load(self, namespace, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?",
+                                     (namespace, json.dumps(key))).fetchone()
+
+        return pickle.loads(row[0]) if row else None
+
+    # Writes the changes in one transaction, a value of None deletes the key
+    def save(self, changes):
+        now = time.time()
+        updates = []
+        deletes = []
+
+        for namespace, key, value in changes:
+            if value is None:
+                deletes.append((namespace, json.dumps(key)))
+            else:
+                updates.append((namespace, json.dumps(key), pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now))
+
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)", updates)
+            self._conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+
+    # Marks the keys as used now, so that the keys that are read but not changed do not expire
+    def touch(self, keys):
+        now = time.time()
+
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE state SET updated = ? WHERE namespace = ? AND key = ?",
+                                   [(now, namespace, json.dumps(key)) for namespace, key in keys])
+
+    def expire(self, before):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM state WHERE updated < ?", (before,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Dict that tells its map when it changes, so that the change can be saved
+class StateDict(dict):
+    def __init__(self, on_change, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._on_change()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._on_change()
+
+    def pop(self, key, *args):
+        had_key = key in self
+        value = super().pop(key, *args)
+
+        if had_key:
+            self._on_change()
+
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_change()
+
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._on_change()
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
+
+# Mapping of a namespace of the store. The entries that are in use are kept in memory and the ones that have been
+# idle for too long are dropped. With a factory, missing keys are created on access like a defaultdict.
+# The keys that the backend does not have are remembered too, as ConversationHandler looks up the conversation of every
+# update. The updates of a chat are handled by one process, so no other process adds them in the meantime.
+class StateMap(MutableMapping):
+    def __init__(self, store, namespace, factory=None, persist=None):
+        self.store = store
+        self.namespace = namespace
+        self.factory = factory
+        self.persist = persist
+        self._entries = {}
+        self._missing = {}
+
+    def __getitem__(self, key):
+        with self.store.lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                entry[0] = time.monotonic()
+
+                return entry[1]
+
+            value = self._load(key)
+
+            if value is None:
+                if self.factory is None:
+                    raise KeyError(key)
+
+                value = self.factory()
+
+            value = self._wrap(key, value)
+            self._entries[key] = [time.monotonic(), value]
+
+            return value
+
+    def __setitem__(self, key, value):
+        with self.store.lock:
+            self._entries[key] = [time.monotonic(), self._wrap(key, value)]
+            self._missing.pop(key, None)
+            self.store.mark_dirty(self, key)
+
+    def __delitem__(self, key):
+        with self.store.lock:
+            if key not in self:
+                raise KeyError(key)
+
+            self._entries.pop(key, None)
+            self._missing[key] = time.monotonic()
+            self.store.mark_dirty(self, key)
+
+    def __contains__(self, key):
+        with self.store.lock:
+            return key in self._entries or self._load(key) is not None
+
+    # Only the entries in memory are listed
+    def __iter__(self):
+        with self.store.lock:
+            return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Loads the value of the key from the backend, or returns None if the backend does not have it
+    def _load(self, key):
+        if key in self._missing:
+            self._missing[key] = time.monotonic()
+
+            return None
+
+        value = self.store.backend.load(self.namespace, key)
+
+        if value is None:
+            self._missing[key] = time.monotonic()
+
+        return value
+
+    def _wrap(self, key, value):
+        if isinstance(value, dict) and not isinstance(value, StateDict):
+            value = StateDict(lambda: self.store.mark_dirty(self, key), value)
+
+        return value
+
+    # Returns the value to save for the key, or None to delete it
+    def snapshot(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        value = entry[1]
+
+        if isinstance(value, dict):
+            value = dict(value)
+
+        return self.persist(value) if self.persist else value
+
+    # Returns the keys in memory that have been used since the time
+    def used_since(self, since):
+        return [key for key, entry in self._entries.items() if entry[0] >= since]
+
+    # Drops the idle entries from memory, except the ones with changes that have not been saved yet
+    def evict(self, before, dirty):
+        for key, entry in list(self._entries.items()):
+            if entry[0] < before and (self.namespace, json.dumps(key)) not in dirty:
+                del self._entries[key]
+
+        for key, used in list(self._missing.items()):
+            if used < before:
+                del self._missing[key]
+
+
+# Conversation state and user data with idle eviction, saved to the backend in batches by a background thread
+class StateStore(object):
+    def __init__(self, backend=None, idle_timeout=86400, flush_interval=1, batch_size=100, sweep_interval=60):
+        self.backend = backend if backend else MemoryBackend()
+        self.idle_timeout = idle_timeout
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.sweep_interval = sweep_interval
+        self.lock = threading.RLock()
+        self._maps = []
+        self._dirty = {}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._last_sweep = time.monotonic()
+
+    def mapping(self, namespace, factory=None, persist=None):
+        state_map = StateMap(self, namespace, factory, persist)
+        self._maps.append(state_map)
+
+        return state_map
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self, state_map, key):
+        if not self.backend.persistent:
+            return
+
+        with self.lock:
+            self._dirty[(state_map.namespace, json.dumps(key))] = (state_map, key)
+
+            if len(self._dirty) >= self.batch_size:
+                self._wakeup.set()
+
+    # Saves the changes since the last flush
+    def flush(self):
+        with self.lock:
+            dirty = self._dirty
+            self._dirty = {}
+            changes = [(state_map.namespace, key, state_map.snapshot(key)) for state_map, key in dirty.values()]
+
+        if changes:
+            try:
+                self.backend.save(changes)
+            except Exception as e:
+                logger.error("Failed to save the state: %s" % e)
+
+                with self.lock:
+                    for dirty_key, value in dirty.items():
+                        self._dirty.setdefault(dirty_key, value)
+
+    # Drops the entries that have been idle for too long. The saved entries that have been used since the last sweep
+    # are touched first, so that only the ones that are idle in memory too expire from the backend.
+    def sweep(self):
+        with self.lock:
+            now = time.monotonic()
+            used = [(x.namespace, key) for x in self._maps for key in x.used_since(self._last_sweep)]
+            self._last_sweep = now
+
+            for state_map in self._maps:
+                state_map.evict(now - self.idle_timeout, self._dirty)
+
+        if used:
+            self.backend.touch(used)
+
+        self.backend.expire(time.time() - self.idle_timeout)
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+        self.backend.close()
+
+    def _run(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+            if time.monotonic() >= next_sweep:
+                self.sweep()
+                next_sweep = time.monotonic() + self.sweep_interval
+
+
+# ConversationHandler keeps a pending run_async state as (old state, promise), only the old state can be saved
+def conversation_state(value):
+    return value[0] if isinstance(value, tuple) else value
@@ -0,0 +1,179 @@
+# coding: utf-8
+
+import collections
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# Stacks that end in these files are threads waiting rather than running
+idle_files = ("threading.py", "selectors.py", "queue.py", "socket.py", "ssl.py", "socketserver.py")
+
+
+class Span(object):
+    __slots__ = ("name", "attrs", "start", "end", "children")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin):
+        return {"name": self.name, "start_ms": round((self.start - origin) * 1000, 3),
+                "duration_ms": round(self.duration * 1000, 3), "attrs": self.attrs,
+                "children": [x.to_dict(origin) for x in self.children]}
+
+
+# Samples the stacks of all the threads while there are traces in progress
+class StackSampler(object):
+    def __init__(self, interval=0.01, max_samples=50000):
+        self.interval = interval
+        self._samples = collections.deque(maxlen=max_samples)
+        self._active = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def begin(self):
+        with self._lock:
+            self._active += 1
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+
+        self._wakeup.set()
+
+    def end(self):
+        with self._lock:
+            self._active -= 1
+
+            if self._active == 0:
+                self._wakeup.clear()
+
+    # Returns the number of samples of each stack taken between the two times, the most common first
+    def profile(self, start, end, limit=50):
+        counts = collections.Counter(stack for sample_time, stack in list(self._samples) if start <= sample_time <= end)
+
+        return counts.most_common(limit)
+
+    def _run(self):
+        own_id = threading.get_ident()
+
+        while True:
+            self._wakeup.wait()
+            now = time.perf_counter()
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id and os.path.basename(frame.f_code.co_filename) not in idle_files:
+                    self._samples.append((now, self._format_stack(frame)))
+
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _format_stack(frame, limit=40):
+        names = []
+
+        while frame is not None and len(names) < limit:
+            code = frame.f_code
+            names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+
+        return ";".join(reversed(names))
+
+
+# Records a tree of spans for each update, and logs the updates that take longer than the threshold with a
+# sampled profile of what the process was running at the time
+class Tracer(object):
+    def __init__(self, threshold=10, log_path="slow_updates.log", profile_interval=0.01):
+        self.threshold = threshold
+        self.log_path = log_path
+        self.sampler = StackSampler(profile_interval) if profile_interval else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    # Starts a trace, or a span if there is a trace in progress already
+    @contextmanager
+    def trace(self, name, **attrs):
+        if not self.enabled or _current_span.get() is not None:
+            with self.span(name, **attrs) as span:
+                yield span
+
+            return
+
+        root = Span(name, attrs)
+        token = _current_span.set(root)
+
+        if self.sampler:
+            self.sampler.begin()
+
+        try:
+            yield root
+        finally:
+            root.end = time.perf_counter()
+            _current_span.reset(token)
+
+            if self.sampler:
+                self.sampler.end()
+
+            if root.duration >= self.threshold:
+                self._dump(root)
+
+    # Records a span under the current span, does nothing outside of a trace
+    @contextmanager
+    def span(self, name, **attrs):
+        parent = _current_span.get()
+
+        if parent is None:
+            yield None
+
+            return
+
+        span = Span(name, attrs)
+        parent.children.append(span)
+        token = _current_span.set(span)
+
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            _current_span.reset(token)
+
+    # Adds the attributes to the current span
+    def annotate(self, **attrs):
+        span = _current_span.get()
+
+        if span is not None:
+            span.attrs.update(attrs)
+
+    def _dump(self, root):
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "trace": root.to_dict(root.start)}
+
+        if self.sampler:
+            record["profile"] = self.sampler.profile(root.start, root.end)
+
+        logger.warning("Slow update: %s took %.1f seconds" % (root.name, root.duration))
+
+        try:
+            with self._lock, open(self.log_path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            logger.warning("Failed to write slow update to %s: %s" % (self.log_path, e))